@@ -0,0 +1,207 @@
+"""
+Offline CPU benchmark for the BMAB postprocess pipeline.
+
+The webui ``modules`` package is replaced by the stand-ins in ``stubs.py``, detectors
+return synthetic boxes and ``process_images`` only resizes its input, so the numbers
+reported here are BMAB's own overhead (mask building, copies, compositing, arg parsing).
+
+    python benchmark/bench.py --sizes 512,1024 --persons 1,3 --repeat 3
+"""
+import os
+import sys
+import time
+import json
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+import stubs
+stubs.install()
+
+from sd_bmab import bmab, dinosam, util, parameters, instrument
+from modules import shared, processing
+
+
+persons = 1
+
+
+def fake_boxes(width, height, count):
+	boxes = []
+	w = width // (count + 2)
+	for i in range(count):
+		x1 = i * width // (count + 1) + 10
+		y1 = height // 4
+		boxes.append((x1, y1, x1 + w, y1 + height // 2))
+	return boxes
+
+
+def dino_predict(pilimg, prompt, box_threahold=0.35, text_threshold=0.25):
+	boxes, logits, phrases = [], [], []
+	for (x1, y1, x2, y2) in fake_boxes(pilimg.width, pilimg.height, persons):
+		w = x2 - x1
+		for phrase in prompt.replace(' ', '').split('.'):
+			if not phrase:
+				continue
+			if phrase in ('person', 'people'):
+				box = (x1, y1, x2, y2)
+			elif phrase in ('face', 'head'):
+				box = (x1 + w // 4, y1 + 5, x1 + 3 * w // 4, y1 + w // 2)
+			else:
+				box = (x1 + 2, y1 + w, x1 + w // 3, y1 + w + w // 4)
+			boxes.append(box)
+			logits.append(0.5)
+			phrases.append(phrase)
+	return np.array(boxes, dtype=np.float32), np.array(logits), phrases
+
+
+def sam_predict_box(pilimg, box):
+	mask = Image.new('L', pilimg.size, 0)
+	ImageDraw.Draw(mask).ellipse(tuple(int(x) for x in box), fill=255)
+	return mask
+
+
+def sam_predict_boxes(pilimg, boxes):
+	return [sam_predict_box(pilimg, box) for box in boxes]
+
+
+def ultralytics_predict(image, confidence):
+	return [list(box) for box in fake_boxes(image.width, image.height, persons)]
+
+
+dinosam.dino_predict = dino_predict
+dinosam.sam_predict_box = sam_predict_box
+dinosam.sam_predict_boxes = sam_predict_boxes
+util.ultralytics_predict = ultralytics_predict
+
+
+class PostprocessImage(object):
+
+	def __init__(self, image) -> None:
+		self.image = image
+
+
+def make_args(**overrides):
+	keys = [k for k, v in parameters.Parameters().params]
+	args = [v for k, v in parameters.Parameters().params]
+	args[0] = True
+	for k, v in overrides.items():
+		args[keys.index(k)] = v
+	return tuple(args)
+
+
+def make_processing(size):
+	p = processing.StableDiffusionProcessingTxt2Img(
+		prompt='1girl', negative_prompt='', width=size, height=size, seed=1, subseed=1, all_seeds=[1], all_subseeds=[1],
+		all_prompts=['1girl'], all_negative_prompts=[''], styles=[], subseed_strength=0, seed_resize_from_h=0, seed_resize_from_w=0,
+		sampler_name='Euler', steps=20, cfg_scale=7, tiling=False, outpath_samples='', outpath_grids='', override_settings={},
+		sd_model=None, enable_hr=False, batch_size=1, iteration=0,
+	)
+	p.scripts = type('ScriptRunner', (), {'alwayson_scripts': []})()
+	p.script_args = ()
+	return p
+
+
+def pipeline_args():
+	overrides = dict(
+		contrast=1.2, brightness=0.9, sharpeness=1.5, color_saturation=1.1, color_temperature=300,
+		person_detailing_enabled=True, face_detailing_enabled=True, hand_detailing_enabled=True,
+		resize_by_person_enabled=True, upscale_enabled=True,
+	)
+	overrides['module_config.person_detailing_opt.area_ratio'] = 0.5
+	overrides['module_config.person_detailing_opt.limit'] = 0
+	overrides['module_config.face_detailing_opt.limit'] = 0
+	return make_args(**overrides)
+
+
+def run_once(script, size, args, seed):
+	p = make_processing(size)
+	image = Image.fromarray(np.random.RandomState(seed).randint(0, 255, (size, size, 3), dtype=np.uint8))
+	pp = PostprocessImage(image)
+
+	collected = []
+	instrument_end = instrument.end
+
+	def end(p, index=0):
+		collected.extend(record.to_dict() for record in instrument.records)
+		instrument_end(p, index)
+
+	instrument.end = end
+	try:
+		start = time.time()
+		script.before_process(p, *args)
+		parse = time.time() - start
+		script.postprocess_image(p, pp, *args)
+		script.postprocess(p, processing.Processed(p, []), *args)
+		total = time.time() - start
+	finally:
+		instrument.end = instrument_end
+
+	collected.append(dict(stage='parse_args', depth=0, wall=parse, load=0, inference=0, img2img=0))
+	collected.append(dict(stage='total', depth=0, wall=total, load=0, inference=0, img2img=stubs.stats['img2img']))
+	stubs.stats.update(img2img=0, items=0)
+	return collected
+
+
+def summarize(runs):
+	stages = {}
+	for run in runs:
+		for record in run:
+			stages.setdefault((record['stage'], record['depth']), []).append(record)
+
+	summary = []
+	for (name, depth), records in stages.items():
+		wall = sum(r['wall'] for r in records) / len(runs)
+		model = sum(r['load'] + r['inference'] for r in records) / len(runs)
+		summary.append(dict(
+			stage=name, depth=depth, calls=len(records) // len(runs),
+			wall=round(wall, 4), overhead=round(wall - model, 4),
+			img2img=sum(r['img2img'] for r in records) // len(runs),
+		))
+	return summary
+
+
+def print_summary(size, count, summary):
+	print(f'size {size}x{size}, persons {count}')
+	print(f'  {"stage":<40}{"calls":>6}{"wall":>10}{"overhead":>10}{"img2img":>9}')
+	for row in summary:
+		name = '  ' * row['depth'] + row['stage']
+		print(f'  {name:<40}{row["calls"]:>6}{row["wall"]:>10.4f}{row["overhead"]:>10.4f}{row["img2img"]:>9}')
+	print()
+
+
+def main():
+	global persons
+
+	parser = argparse.ArgumentParser(description='BMAB postprocess CPU benchmark')
+	parser.add_argument('--sizes', default='512,1024', help='comma separated image sizes')
+	parser.add_argument('--persons', default='1,3', help='comma separated person counts')
+	parser.add_argument('--repeat', type=int, default=3, help='runs per configuration')
+	parser.add_argument('--batch', type=int, default=1, help='bmab_detailing_batch_size')
+	parser.add_argument('--json', default='', help='write the summary to this file')
+	options = parser.parse_args()
+
+	shared.opts.data['bmab_detailing_batch_size'] = options.batch
+	args = pipeline_args()
+	results = []
+	for size in [int(x) for x in options.sizes.split(',')]:
+		for count in [int(x) for x in options.persons.split(',')]:
+			persons = count
+			script = bmab.BmabExtScript()
+			run_once(script, size, args, 0)
+			runs = [run_once(script, size, args, random.randrange(1 << 16)) for _ in range(options.repeat)]
+			summary = summarize(runs)
+			print_summary(size, count, summary)
+			results.append(dict(size=size, persons=count, stages=summary))
+
+	if options.json:
+		with open(options.json, 'w') as f:
+			json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+	main()
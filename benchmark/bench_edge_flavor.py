@@ -0,0 +1,70 @@
+"""
+Old (per-pixel getdata/putdata) vs new (NumPy) process.edge_flavor.
+
+Both versions run on the same synthetic images; the script checks that the outputs
+are byte identical and prints the mean time per call for each size.
+
+    python benchmark/bench_edge_flavor.py --sizes 512,1024,2048 --repeat 3
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cv2
+import numpy as np
+from PIL import Image, ImageOps, ImageFilter
+
+import stubs
+stubs.install()
+
+from sd_bmab import process
+
+
+def edge_flavor_old(pil, canny_th1: int, canny_th2: int, strength: float):
+	numpy_image = np.array(pil)
+	base = cv2.cvtColor(numpy_image, cv2.COLOR_RGB2BGR)
+	arcanny = cv2.Canny(base, canny_th1, canny_th2)
+	canny = Image.fromarray(arcanny)
+	canny = ImageOps.invert(canny)
+
+	newdata = [(0, 0, 0) if mdata == 0 else ndata for mdata, ndata in zip(canny.getdata(), pil.getdata())]
+	newbase = Image.new('RGB', pil.size)
+	newbase.putdata(newdata)
+	return Image.blend(pil, newbase, alpha=strength).convert("RGB")
+
+
+def make_image(size):
+	rnd = np.random.RandomState(size)
+	image = Image.fromarray(rnd.randint(0, 255, (size // 8, size // 8, 3), dtype=np.uint8))
+	return image.resize((size, size), resample=Image.NEAREST).filter(ImageFilter.GaussianBlur(2))
+
+
+def timeit(func, repeat):
+	start = time.time()
+	for _ in range(repeat):
+		result = func()
+	return result, (time.time() - start) / repeat
+
+
+def main():
+	parser = argparse.ArgumentParser(description='edge_flavor old vs new')
+	parser.add_argument('--sizes', default='512,1024,2048', help='comma separated image sizes')
+	parser.add_argument('--repeat', type=int, default=3, help='runs per size')
+	parser.add_argument('--strength', type=float, default=0.5)
+	options = parser.parse_args()
+
+	print(f'{"size":>6}{"old":>12}{"new":>12}{"speedup":>10}  identical')
+	for size in [int(x) for x in options.sizes.split(',')]:
+		image = make_image(size)
+		old, old_time = timeit(lambda: edge_flavor_old(image, 50, 200, options.strength), options.repeat)
+		new, new_time = timeit(lambda: process.edge_flavor(image, 50, 200, options.strength), options.repeat)
+		identical = old.tobytes() == new.tobytes()
+		print(f'{size:>6}{old_time * 1000:>10.1f}ms{new_time * 1000:>10.1f}ms{old_time / new_time:>9.1f}x  {identical}')
+
+
+if __name__ == '__main__':
+	main()
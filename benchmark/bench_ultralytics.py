@@ -0,0 +1,99 @@
+"""
+Per-image face detection latency of util.ultralytics_predict, cold vs resident.
+
+"reload" releases the ultralytics registry before every image, which is what every
+call paid before models were kept resident; "resident" loads once and then only runs
+inference. When face_yolov8n.pt and ultralytics are not available, a fake YOLO with
+a fixed load and inference cost stands in so the registry behaviour can still be seen.
+
+    python benchmark/bench_ultralytics.py --images 8 --models /path/to/webui/models
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+from PIL import Image
+
+import stubs
+stubs.install()
+
+
+class FakeBoxes(object):
+
+	def __init__(self, image) -> None:
+		w, h = image.size
+		self.xyxy = self
+		self.boxes = np.array([[w * 0.4, h * 0.2, w * 0.6, h * 0.4]], dtype=np.float32)
+
+	def cpu(self):
+		return self
+
+	def numpy(self):
+		return self.boxes
+
+
+class FakeYOLO(object):
+	load_time = 0.5
+	inference_time = 0.02
+
+	def __init__(self, model_path) -> None:
+		time.sleep(self.load_time)
+
+	def __call__(self, image, conf=0.35, device=''):
+		time.sleep(self.inference_time)
+		return [FakeBoxes(image)]
+
+
+def measure(images, release):
+	from sd_bmab import util
+
+	latencies = []
+	util.ultralytics_release()
+	for image in images:
+		if release:
+			util.ultralytics_release()
+		start = time.time()
+		util.ultralytics_predict(image, 0.35)
+		latencies.append(time.time() - start)
+	return latencies
+
+
+def report(name, latencies):
+	steady = latencies[1:] or latencies
+	print(f'{name:<10}first {latencies[0] * 1000:9.1f} ms   after warmup {sum(steady) / len(steady) * 1000:9.1f} ms/image   total {sum(latencies):7.2f} s')
+
+
+def main():
+	parser = argparse.ArgumentParser(description='ultralytics face detector latency')
+	parser.add_argument('--images', type=int, default=8, help='images per run')
+	parser.add_argument('--size', type=int, default=512, help='image size')
+	parser.add_argument('--models', default='', help='webui models directory containing bmab/face_yolov8n.pt')
+	parser.add_argument('--load-ms', type=float, default=500, help='fake model load time')
+	parser.add_argument('--inference-ms', type=float, default=20, help='fake inference time')
+	options = parser.parse_args()
+
+	if options.models:
+		sys.modules['modules.paths'].models_path = options.models
+
+	from sd_bmab import util
+
+	model_file = os.path.join(util.models_path, 'bmab', 'face_yolov8n.pt')
+	if util.YOLO is None or not os.path.exists(model_file):
+		print('face_yolov8n.pt or ultralytics not available, using a fake detector')
+		FakeYOLO.load_time = options.load_ms / 1000
+		FakeYOLO.inference_time = options.inference_ms / 1000
+		util.YOLO = FakeYOLO
+
+	rnd = np.random.RandomState(0)
+	images = [Image.fromarray(rnd.randint(0, 255, (options.size, options.size, 3), dtype=np.uint8)) for _ in range(options.images)]
+	report('reload', measure(images, True))
+	report('resident', measure(images, False))
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,225 @@
+import sys
+import types
+import contextlib
+import importlib.util
+
+import numpy as np
+from PIL import Image
+
+
+stats = {'img2img': 0, 'items': 0}
+
+
+def module(name, **attrs):
+	m = types.ModuleType(name)
+	m.__dict__.update(attrs)
+	sys.modules[name] = m
+	parent, _, child = name.rpartition('.')
+	if parent:
+		setattr(sys.modules[parent], child, m)
+	return m
+
+
+def available(name):
+	try:
+		return importlib.util.find_spec(name) is not None
+	except (ImportError, ValueError):
+		return False
+
+
+class Opts(object):
+
+	def __init__(self) -> None:
+		self.data = {
+			'bmab_debug_print': False,
+			'bmab_show_extends': False,
+			'bmab_test_function': False,
+			'bmab_keep_original_setting': False,
+			'bmab_save_image_before_process': False,
+			'bmab_save_image_after_process': False,
+			'bmab_max_detailing_element': 0,
+			'bmab_detail_full': True,
+			'bmab_use_specific_model': False,
+			'bmab_model': '',
+			'sd_model_checkpoint': 'fake',
+			'img2img_fix_steps': False,
+			'samples_format': 'png',
+			'img2img_background_color': '#ffffff',
+		}
+		self.options = {}
+
+	def __getattr__(self, item):
+		data = self.__dict__.get('data', {})
+		if item in data:
+			return data[item]
+		if item in self.__dict__.get('options', {}):
+			return self.options[item].default
+		raise AttributeError(item)
+
+	def __setattr__(self, key, value):
+		if key in ('data', 'options'):
+			object.__setattr__(self, key, value)
+		else:
+			self.data[key] = value
+
+	def add_option(self, key, info):
+		self.options[key] = info
+		self.data.setdefault(key, info.default)
+
+
+class OptionInfo(object):
+
+	def __init__(self, default=None, label='', component=None, component_args=None, section=None, **kwargs) -> None:
+		self.default = default
+		self.label = label
+
+
+class State(object):
+	interrupted = False
+	skipped = False
+	job_count = 0
+
+
+def expand_crop_region(crop_region, processing_width, processing_height, image_width, image_height):
+	x1, y1, x2, y2 = crop_region
+	ratio_crop_region = (x2 - x1) / (y2 - y1)
+	ratio_processing = processing_width / processing_height
+	if ratio_crop_region > ratio_processing:
+		desired_height = (x2 - x1) / ratio_processing
+		desired_height_diff = int(desired_height - (y2 - y1))
+		y1 -= desired_height_diff // 2
+		y2 += desired_height_diff - desired_height_diff // 2
+		if y2 >= image_height:
+			diff = y2 - image_height
+			y2 -= diff
+			y1 -= diff
+		if y1 < 0:
+			y2 -= y1
+			y1 -= y1
+		if y2 >= image_height:
+			y2 = image_height
+	else:
+		desired_width = (y2 - y1) * ratio_processing
+		desired_width_diff = int(desired_width - (x2 - x1))
+		x1 -= desired_width_diff // 2
+		x2 += desired_width_diff - desired_width_diff // 2
+		if x2 >= image_width:
+			diff = x2 - image_width
+			x2 -= diff
+			x1 -= diff
+		if x1 < 0:
+			x2 -= x1
+			x1 -= x1
+		if x2 >= image_width:
+			x2 = image_width
+	return x1, y1, x2, y2
+
+
+def flatten(img, bgcolor):
+	if img.mode == 'RGBA':
+		background = Image.new('RGBA', img.size, bgcolor)
+		background.paste(img, mask=img)
+		img = background
+	return img.convert('RGB')
+
+
+def resize_image(resize_mode, im, width, height, upscaler_name=None):
+	if upscaler_name == 'Nearest':
+		return im.resize((width, height), resample=Image.NEAREST)
+	return im.resize((width, height), resample=Image.LANCZOS)
+
+
+class Processing(object):
+	cached_c = [None, None]
+	cached_uc = [None, None]
+
+	def __init__(self, **kwargs) -> None:
+		self.__dict__.update(kwargs)
+		self.extra_generation_params = kwargs.get('extra_generation_params', {})
+		self.scripts = None
+		self.script_args = ()
+
+	def close(self):
+		pass
+
+
+class StableDiffusionProcessingImg2Img(Processing):
+	pass
+
+
+class StableDiffusionProcessingTxt2Img(Processing):
+
+	def sample(self, *args, **kwargs):
+		pass
+
+
+class Processed(object):
+
+	def __init__(self, p, images, seed=0, info='') -> None:
+		self.images = images
+
+
+def process_images(p):
+	stats['img2img'] += 1
+	out = []
+	for img in p.init_images:
+		stats['items'] += 1
+		if getattr(p, 'mask', None) is not None and getattr(p, 'inpaint_full_res', 0):
+			out.append(img.convert('RGB').copy())
+		else:
+			out.append(img.convert('RGB').resize((int(p.width), int(p.height))))
+	return Processed(p, out)
+
+
+def install_third_party():
+	if not available('torch'):
+		torch = module('torch', load=lambda *a, **k: None, float32=np.float32, from_numpy=np.asarray, Tensor=lambda x: np.asarray(x, dtype=np.float32), no_grad=contextlib.nullcontext)
+		module('torch.cuda', is_available=lambda: False, empty_cache=lambda: None)
+		module('torch.nn', Module=object)
+		torch.version = types.SimpleNamespace(cuda=None)
+	if not available('torchvision'):
+		module('torchvision')
+		module('torchvision.ops', box_convert=lambda boxes, in_fmt, out_fmt: boxes)
+	if not available('groundingdino'):
+		module('groundingdino')
+		module('groundingdino.util')
+		module('groundingdino.util.inference', load_model=lambda *a, **k: types.SimpleNamespace(backbone=types.SimpleNamespace(forward=None)), predict=None)
+		module('groundingdino.datasets')
+		module('groundingdino.datasets.transforms', Compose=None, RandomResize=None, ToTensor=None, Normalize=None)
+	if not available('segment_anything'):
+		module('segment_anything', SamPredictor=None, sam_model_registry={})
+	if not available('ultralytics'):
+		module('ultralytics', YOLO=None)
+	if not available('gradio'):
+		module('gradio', Slider=None, Checkbox=None, Textbox=None, Dropdown=None, Radio=None, Image=None, Button=None, Markdown=None)
+
+
+def install():
+	install_third_party()
+
+	modules = module('modules')
+	module('modules.shared', opts=Opts(), state=State(), OptionInfo=OptionInfo, device='cpu', sd_model=None, sd_upscalers=[], list_samplers=lambda: [])
+	module('modules.devices', dtype_vae=np.float32, device='cpu', torch_gc=lambda: None)
+	module('modules.safe', unsafe_torch_load=lambda *a, **k: None, load=lambda *a, **k: None)
+	module('modules.paths', models_path='/tmp/bmab-benchmark-models')
+	module('modules.sd_samplers', sample_to_image=lambda x, index=0, approximation=0: x[index])
+	module('modules.masking', expand_crop_region=expand_crop_region)
+	module('modules.sd_vae')
+	module('modules.sd_models')
+	module('modules.script_callbacks', on_ui_settings=lambda f: None)
+	module('modules.images', flatten=flatten, resize_image=resize_image, save_image=lambda *a, **k: None)
+
+	class Script(object):
+		filename = 'bmab.py'
+
+	module('modules.scripts', Script=Script, AlwaysVisible=object())
+	module(
+		'modules.processing',
+		StableDiffusionProcessingImg2Img=StableDiffusionProcessingImg2Img,
+		StableDiffusionProcessingTxt2Img=StableDiffusionProcessingTxt2Img,
+		Processed=Processed,
+		process_images=process_images,
+		process_images_inner=None,
+	)
+	module('modules.img2img', process_batch=None)
+	return modules
@@ -6,11 +6,10 @@ from modules import shared
 from modules import script_callbacks
 from modules import processing
 from modules import img2img
-from modules import images
 from modules.processing import StableDiffusionProcessingImg2Img
 from modules.processing import StableDiffusionProcessingTxt2Img, Processed
 
-from sd_bmab import dinosam, process, detailing, parameters, util, controlnet, constants
+from sd_bmab import dinosam, process, detailing, parameters, util, controlnet, constants, instrument, writer
 from sd_bmab.util import debug_print
 
 
@@ -91,8 +90,9 @@ class BmabExtScript(scripts.Script):
 
 	def __init__(self) -> None:
 		super().__init__()
-		self.extra_image = []
+		self.extra_image = util.ExtraImages()
 		self.config = {}
+		self.parsed = None
 		self.index = 0
 
 	def title(self):
@@ -105,17 +105,23 @@ class BmabExtScript(scripts.Script):
 		return self._create_ui(is_img2img)
 
 	def parse_args(self, args):
-		self.config = parameters.Parameters().load_preset(args)
-		ar = parameters.Parameters().get_dict(args, self.config)
-		return ar
+		key = tuple(id(x) for x in args)
+		if self.parsed is None or self.parsed[0] != key:
+			self.config = parameters.Parameters().load_preset(args)
+			ar = parameters.Parameters().get_config(args, self.config)
+			self.parsed = (key, ar)
+		return self.parsed[1].copy()
 
 	def before_process(self, p, *args):
-		self.extra_image = []
+		self.extra_image.clear()
+		self.parsed = None
 		self.index = 0
 		a = self.parse_args(args)
-		if not a['enabled']:
+		if not a.enabled:
 			return
 
+		dinosam.cancel_release()
+
 		if isinstance(p, StableDiffusionProcessingTxt2Img):
 			process.override_sample(self, p, a)
 
@@ -126,17 +132,17 @@ class BmabExtScript(scripts.Script):
 
 	def process_batch(self, p, *args, **kwargs):
 		a = self.parse_args(args)
-		if not a['enabled']:
+		if not a.enabled:
 			return
 
 		if isinstance(p, StableDiffusionProcessingTxt2Img) and p.enable_hr:
-			a['max_area'] = p.hr_upscale_to_x * p.hr_upscale_to_y
+			a.max_area = p.hr_upscale_to_x * p.hr_upscale_to_y
 
 		process.process_img2img_process_all(self, p, a)
 
 	def postprocess_image(self, p, pp, *args):
 		a = self.parse_args(args)
-		if not a['enabled']:
+		if not a.enabled:
 			return
 
 		if shared.state.interrupted or shared.state.skipped:
@@ -144,28 +150,39 @@ class BmabExtScript(scripts.Script):
 
 		image = pp.image.copy()
 		if shared.opts.bmab_save_image_before_process:
-			images.save_image(pp.image, p.outpath_samples, "", p.all_seeds[self.index], p.all_prompts[self.index], shared.opts.samples_format, p=p, suffix="-before-bmab")
+			writer.image_writer.save(pp.image, p.outpath_samples, "", p.all_seeds[self.index], p.all_prompts[self.index], shared.opts.samples_format, p=p, suffix="-before-bmab")
 		self.extra_image.append(pp.image)
 
+		instrument.begin()
 		with PreventControlNet(p), CheckpointChanger():
-			image = process.process_resize_by_person(image, self, p, a, caller='postprocess_image')
-			image = process.process_upscale_before_detailing(image, self, p, a)
-			image = detailing.process_person_detailing(image, self, p, a)
-			image = detailing.process_face_detailing(image, self, p, a)
-			image = detailing.process_hand_detailing(image, self, p, a)
-			image = process.process_upscale_after_detailing(image, self, p, a)
-			image = process.after_process(image, self, p, a)
+			with instrument.stage('resize_by_person'):
+				image = process.process_resize_by_person(image, self, p, a, caller='postprocess_image')
+			with instrument.stage('upscale_before_detailing'):
+				image = process.process_upscale_before_detailing(image, self, p, a)
+			with instrument.stage('person_detailing'):
+				image = detailing.process_person_detailing(image, self, p, a)
+			with instrument.stage('face_detailing'):
+				image = detailing.process_face_detailing(image, self, p, a)
+			with instrument.stage('hand_detailing'):
+				image = detailing.process_hand_detailing(image, self, p, a)
+			with instrument.stage('upscale_after_detailing'):
+				image = process.process_upscale_after_detailing(image, self, p, a)
+			with instrument.stage('after_process'):
+				image = process.after_process(image, self, p, a)
+		instrument.end(p, self.index)
 		pp.image = image
 
 		if shared.opts.bmab_save_image_after_process:
-			images.save_image(pp.image, p.outpath_samples, "", p.all_seeds[self.index], p.all_prompts[self.index], shared.opts.samples_format, p=p, suffix="-after-bmab")
+			writer.image_writer.save(pp.image, p.outpath_samples, "", p.all_seeds[self.index], p.all_prompts[self.index], shared.opts.samples_format, p=p, suffix="-after-bmab")
 
 		self.index += 1
 
 	def postprocess(self, p, processed, *args):
 		if shared.opts.bmab_show_extends:
-			processed.images.extend(self.extra_image)
-		dinosam.release()
+			processed.images.extend(self.extra_image.images())
+		writer.image_writer.flush()
+		self.parsed = None
+		dinosam.release_by_policy()
 
 	def describe(self):
 		return 'This stuff is worth it, you can buy me a beer in return.'
@@ -448,17 +465,38 @@ class BmabExtScript(scripts.Script):
 def on_ui_settings():
 	shared.opts.add_option('bmab_debug_print', shared.OptionInfo(False, 'Print debug message.', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_show_extends', shared.OptionInfo(False, 'Show before processing image. (DO NOT ENABLE IN CLOUD)', section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_extra_image_budget', shared.OptionInfo(
+		default=256, label='Memory budget for extended images (MB, the rest is kept in a temporary folder)', component=gr.Slider, component_args={'minimum': 0, 'maximum': 4096, 'step': 16}, section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_test_function', shared.OptionInfo(False, 'Show Test Function', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_keep_original_setting', shared.OptionInfo(False, 'Keep original setting', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_save_image_before_process', shared.OptionInfo(False, 'Save image that before processing', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_save_image_after_process', shared.OptionInfo(False, 'Save image that after processing (some bugs)', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_max_detailing_element', shared.OptionInfo(
 		default=0, label='Max Detailing Element', component=gr.Slider, component_args={'minimum': 0, 'maximum': 10, 'step': 1}, section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_detailing_batch_size', shared.OptionInfo(
+		default=1, label='Detailing batch size (EXPERIMENTAL, 1 = process one by one)', component=gr.Slider, component_args={'minimum': 1, 'maximum': 8, 'step': 1}, section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_upscale_tile_size', shared.OptionInfo(
+		default=0, label='Upscale tile size (0 = upscale whole image at once)', component=gr.Slider, component_args={'minimum': 0, 'maximum': 2048, 'step': 64}, section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_upscale_tile_overlap', shared.OptionInfo(
+		default=64, label='Upscale tile overlap', component=gr.Slider, component_args={'minimum': 0, 'maximum': 256, 'step': 8}, section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_detection_cache', shared.OptionInfo(False, 'Cache detection results on disk', section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_detection_cache_size', shared.OptionInfo(
+		default=512, label='Detection cache size (MB)', component=gr.Slider, component_args={'minimum': 16, 'maximum': 8192, 'step': 16}, section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_trace_file', shared.OptionInfo(
+		default='', label='Stage trace file (JSONL, empty = disabled)', component=gr.Textbox, component_args='', section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_trace_infotext', shared.OptionInfo(False, 'Add stage timing summary to infotext', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_detail_full', shared.OptionInfo(True, 'Allways use FULL, VAE type for encode when detail anything. (v1.6.0)', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_use_specific_model', shared.OptionInfo(False, 'Use specific model', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_model', shared.OptionInfo(default='', label='Checkpoint for Person, Face, Hand', component=gr.Textbox, component_args='', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_cn_openpose', shared.OptionInfo(default='control_v11p_sd15_openpose_fp16 [73c2b67d]', label='ControlNet openpose model', component=gr.Textbox, component_args='', section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_cn_lineart', shared.OptionInfo(default='control_v11p_sd15_lineart [43d4be0d]', label='ControlNet lineart model', component=gr.Textbox, component_args='', section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_model_residency', shared.OptionInfo(
+		default=constants.model_residency_default, label='Detection model residency', component=gr.Radio,
+		component_args={'choices': [constants.model_residency_default, constants.model_residency_always, constants.model_residency_idle, constants.model_residency_vram]}, section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_model_idle_timeout', shared.OptionInfo(
+		default=300, label='Idle timeout (sec) before releasing detection models', component=gr.Slider, component_args={'minimum': 10, 'maximum': 3600, 'step': 10}, section=('bmab', 'BMAB')))
+	shared.opts.add_option('bmab_model_min_free_vram', shared.OptionInfo(
+		default=20, label='Release detection models when free VRAM is below (%)', component=gr.Slider, component_args={'minimum': 1, 'maximum': 90, 'step': 1}, section=('bmab', 'BMAB')))
 	shared.opts.add_option('bmab_cn_inpaint', shared.OptionInfo(default='control_v11p_sd15_inpaint_fp16 [be8bc0ed]', label='ControlNet inpaint model', component=gr.Textbox, component_args='', section=('bmab', 'BMAB')))
 
 
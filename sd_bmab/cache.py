@@ -0,0 +1,129 @@
+import os
+import io
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+
+from modules import shared
+from modules.paths import models_path
+
+
+cache_dir = os.path.join(models_path, 'bmab', 'cache')
+model_hashes = {}
+
+
+def is_enabled():
+	return shared.opts.data.get('bmab_detection_cache', False)
+
+
+def get_size_limit():
+	return shared.opts.data.get('bmab_detection_cache_size', 512) * 1024 * 1024
+
+
+def model_hash(path):
+	try:
+		stat = os.stat(path)
+	except OSError:
+		return None
+	key = (path, stat.st_size, stat.st_mtime_ns)
+	value = model_hashes.get(key)
+	if value is None:
+		h = hashlib.sha1()
+		h.update(f'{os.path.basename(path)}{stat.st_size}'.encode())
+		with open(path, 'rb') as f:
+			h.update(f.read(1024 * 1024))
+			if stat.st_size > 1024 * 1024:
+				f.seek(-1024 * 1024, os.SEEK_END)
+				h.update(f.read(1024 * 1024))
+		value = h.hexdigest()
+		model_hashes[key] = value
+	return value
+
+
+def make_key(*args):
+	return hashlib.sha1(json.dumps(args, default=str).encode()).hexdigest()
+
+
+def pack_masks(masks):
+	masks = np.asarray(masks, dtype=bool)
+	return dict(shape=np.array(masks.shape), bits=np.packbits(masks.reshape(-1)))
+
+
+def unpack_masks(data):
+	shape = tuple(int(x) for x in data['shape'])
+	count = int(np.prod(shape))
+	return np.unpackbits(data['bits'], count=count).astype(bool).reshape(shape)
+
+
+class DetectionCache(object):
+
+	def __init__(self, path) -> None:
+		super().__init__()
+		self.path = path
+		self.lock = threading.Lock()
+		self.connection = None
+
+	def connect(self):
+		if self.connection is None:
+			os.makedirs(self.path, exist_ok=True)
+			self.connection = sqlite3.connect(os.path.join(self.path, 'detection.db'), check_same_thread=False)
+			self.connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, size INTEGER, last_access REAL)')
+			self.connection.commit()
+		return self.connection
+
+	def filename(self, key):
+		return os.path.join(self.path, f'{key}.npz')
+
+	def get(self, key):
+		if not is_enabled():
+			return None
+		with self.lock:
+			db = self.connect()
+			row = db.execute('SELECT key FROM entries WHERE key = ?', (key,)).fetchone()
+			if row is None:
+				return None
+			try:
+				with np.load(self.filename(key), allow_pickle=False) as data:
+					result = {k: data[k] for k in data.files}
+			except (OSError, ValueError):
+				db.execute('DELETE FROM entries WHERE key = ?', (key,))
+				db.commit()
+				return None
+			db.execute('UPDATE entries SET last_access = ? WHERE key = ?', (time.time(), key))
+			db.commit()
+			return result
+
+	def put(self, key, **arrays):
+		if not is_enabled():
+			return
+		buffer = io.BytesIO()
+		np.savez_compressed(buffer, **arrays)
+		with self.lock:
+			db = self.connect()
+			with open(self.filename(key), 'wb') as f:
+				f.write(buffer.getvalue())
+			db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?)', (key, buffer.tell(), time.time()))
+			db.commit()
+			self.evict(db)
+
+	def evict(self, db):
+		limit = get_size_limit()
+		total = db.execute('SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+		if total <= limit:
+			return
+		for key, size in db.execute('SELECT key, size FROM entries ORDER BY last_access').fetchall():
+			if total <= limit:
+				break
+			try:
+				os.remove(self.filename(key))
+			except OSError:
+				pass
+			db.execute('DELETE FROM entries WHERE key = ?', (key,))
+			total -= size
+		db.commit()
+
+
+detection_cache = DetectionCache(cache_dir)
@@ -1,2 +1,6 @@
 sampler_default = 'Depends on default'
 resize_mode_default = 'Intermediate'
+model_residency_default = 'Release every job'
+model_residency_always = 'Always resident'
+model_residency_idle = 'Release after idle timeout'
+model_residency_vram = 'Release on VRAM pressure'
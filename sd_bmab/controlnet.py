@@ -1,3 +1,9 @@
+import sys
+import base64
+import importlib
+import numpy as np
+
+from io import BytesIO
 from pathlib import Path
 from PIL import Image
 from PIL import ImageDraw
@@ -11,6 +17,8 @@ from sd_bmab import util, dinosam, process
 
 LANCZOS = (Image.Resampling.LANCZOS if hasattr(Image, 'Resampling') else Image.LANCZOS)
 
+external_code = None
+
 
 def get_cn_args(p):
 	for script_object in p.scripts.alwayson_scripts:
@@ -20,18 +28,42 @@ def get_cn_args(p):
 	return None
 
 
-def b64_encoding(image):
-	from io import BytesIO
-	import base64
+def get_external_code():
+	global external_code
+	if external_code is None:
+		try:
+			external_code = importlib.import_module('extensions.sd-webui-controlnet.scripts.external_code', 'external_code')
+		except ImportError:
+			external_code = next((m for n, m in list(sys.modules.items()) if n.endswith('scripts.external_code') and hasattr(m, 'ControlNetUnit')), False)
+	return external_code
+
 
+def is_numpy_supported():
+	return hasattr(get_external_code(), 'image_dict_from_any')
+
+
+def b64_encoding(image):
 	buffered = BytesIO()
-	image.save(buffered, format="PNG")
+	image.save(buffered, format="PNG", compress_level=1)
 	return base64.b64encode(buffered.getvalue()).decode("utf-8")
 
 
+def get_input_args(image, mask=None):
+	if is_numpy_supported():
+		# an image dict is taken as is; a bare array would hit ControlNet's truthiness check on 'image'
+		image_dict = {
+			'image': np.array(image.convert('RGB')),
+			'mask': None if mask is None else np.array(mask.convert('RGB')),
+		}
+		return {'input_image': image_dict}
+	cn_args = {'input_image': b64_encoding(image)}
+	if mask is not None:
+		cn_args['mask'] = b64_encoding(mask)
+	return cn_args
+
+
 def get_openpose_args(image):
 	cn_args = {
-		'input_image': b64_encoding(image),
 		'module': 'openpose',
 		'model': shared.opts.bmab_cn_openpose,
 		'weight': 1,
@@ -45,13 +77,12 @@ def get_openpose_args(image):
 		'threshold_a': 64,
 		'threshold_b': 64,
 	}
+	cn_args.update(get_input_args(image))
 	return cn_args
 
 
 def get_inpaint_lama_args(image, mask):
 	cn_args = {
-		'input_image': b64_encoding(image),
-		'mask': b64_encoding(mask),
 		'module': 'inpaint_only+lama',
 		'model': shared.opts.bmab_cn_inpaint,
 		'weight': 1,
@@ -65,12 +96,12 @@ def get_inpaint_lama_args(image, mask):
 		'threshold_a': 64,
 		'threshold_b': 64,
 	}
+	cn_args.update(get_input_args(image, mask))
 	return cn_args
 
 
 def get_noise_args(image, weight):
 	cn_args = {
-		'input_image': b64_encoding(image),
 		'model': shared.opts.bmab_cn_lineart,
 		'weight': weight,
 		"guidance_start": 0.1,
@@ -83,6 +114,7 @@ def get_noise_args(image, weight):
 		'threshold_a': 64,
 		'threshold_b': 64,
 	}
+	cn_args.update(get_input_args(image))
 	return cn_args
 
 
@@ -90,23 +122,10 @@ def get_ratio(img, s, p, args, value):
 	p.extra_generation_params['BMAB process_resize_by_person'] = value
 
 	final_ratio = 1
-	dinosam.dino_init()
-	boxes, logits, phrases = dinosam.dino_predict(img, 'person')
-
-	largest = (0, None)
-	for box in boxes:
-		x1, y1, x2, y2 = box
-		size = (x2 - x1) * (y2 - y1)
-		if size > largest[0]:
-			largest = (size, box)
-
-	if largest[0] == 0:
+	ratio = dinosam.person_ratio_estimator.estimate(img)
+	if ratio == 0:
 		return final_ratio
-
-	x1, y1, x2, y2 = largest[1]
-	ratio = (y2 - y1) / img.height
 	print('ratio', ratio)
-	dinosam.release()
 
 	if ratio > value:
 		image_ratio = ratio / value
@@ -162,13 +181,13 @@ def resize_by_person_using_controlnet(s, p, a, cn_num, value, dilation):
 
 
 def process_controlnet(s, p, a):
-	controlnet_opt = a.get('module_config', {}).get('controlnet', {})
+	controlnet_opt = a.module_config.controlnet
 
-	if not controlnet_opt.get('enabled', False):
+	if not controlnet_opt.enabled:
 		return
 
 	p.extra_generation_params['BMAB_controlnet_option'] = util.dict_to_str(controlnet_opt)
-	noise_enabled = controlnet_opt.get('noise', False)
+	noise_enabled = controlnet_opt.noise
 	if not noise_enabled:
 		return
 
@@ -181,7 +200,7 @@ def process_controlnet(s, p, a):
 	count = 0
 
 	if noise_enabled:
-		noise_strength = controlnet_opt.get('noise_strength', 0.4)
+		noise_strength = controlnet_opt.noise_strength
 		print('noise enabled.', noise_strength)
 		p.extra_generation_params['BMAB controlnet mode'] = 'lineart'
 		p.extra_generation_params['BMAB noise strength'] = noise_strength
@@ -1,5 +1,4 @@
 import math
-import time
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFilter
@@ -7,7 +6,7 @@ from PIL import ImageEnhance
 
 from modules import devices
 from modules import shared
-from sd_bmab import dinosam, util, process, constants
+from sd_bmab import dinosam, util, process, constants, instrument
 from sd_bmab.util import debug_print
 
 
@@ -40,11 +39,8 @@ class VAEMethodOverride:
 
 def timecalc(func):
 	def wrapper(*args, **kwargs):
-		start = time.time()
-		ret = func(*args, **kwargs)
-		end = time.time()
-		debug_print(f'{end - start:.2f} sec')
-		return ret
+		with instrument.stage(func.__name__):
+			return func(*args, **kwargs)
 	return wrapper
 
 
@@ -55,9 +51,9 @@ def get_mask(img, prompt):
 
 
 def process_face_detailing(image, s, p, a):
-	face_detailing_opt = a.get('module_config', {}).get('face_detailing_opt', {})
-	detection_model = face_detailing_opt.get('detection_model', 'GroundingDINO')
-	if a['face_detailing_enabled'] or a.get('module_config', {}).get('multiple_face'):
+	face_detailing_opt = a.module_config.face_detailing_opt
+	detection_model = face_detailing_opt.detection_model
+	if a.face_detailing_enabled or a.module_config.get('multiple_face'):
 		if detection_model == 'GroundingDINO':
 			return process_face_detailing_inner(image, s, p, a)
 		else:
@@ -67,15 +63,15 @@ def process_face_detailing(image, s, p, a):
 
 @timecalc
 def process_face_detailing_inner(image, s, p, a):
-	face_detailing_opt = a.get('module_config', {}).get('face_detailing_opt', {})
-	face_detailing = dict(a.get('module_config', {}).get('face_detailing', {}))
-	override_parameter = face_detailing_opt.get('override_parameter', False)
-	dilation = face_detailing_opt.get('dilation', 4)
-	box_threshold = face_detailing_opt.get('box_threshold', 0.35)
+	face_detailing_opt = a.module_config.face_detailing_opt
+	face_detailing = a.module_config.face_detailing.to_dict()
+	override_parameter = face_detailing_opt.override_parameter
+	dilation = face_detailing_opt.dilation
+	box_threshold = face_detailing_opt.box_threshold
 	order = face_detailing_opt.get('order_by', 'Score')
-	limit = face_detailing_opt.get('limit', 1)
-	sampler = face_detailing_opt.get('sampler', constants.sampler_default)
-	best_quality = face_detailing_opt.get('best_quality', False)
+	limit = face_detailing_opt.limit
+	sampler = face_detailing_opt.sampler
+	best_quality = face_detailing_opt.best_quality
 	max_element = shared.opts.bmab_max_detailing_element
 
 	dinosam.dino_init()
@@ -136,6 +132,9 @@ def process_face_detailing_inner(image, s, p, a):
 
 	shared.state.job_count += min(limit, len(candidate))
 
+	only_masked = face_config.get('inpaint_full_res') in ('Only masked', 1)
+	batched = process.get_detailing_batch_size() > 1 and only_masked
+	targets = []
 	for idx, (size, box, logit, phrase) in enumerate(candidate):
 		if phrase != 'face':
 			continue
@@ -168,12 +167,28 @@ def process_face_detailing_inner(image, s, p, a):
 		debug_print('render', phrase, float(logit))
 		debug_print('delation', dilation)
 
+		if batched:
+			targets.append((box, dict(face_config)))
+			continue
+
+		seed, subseed = util.get_seeds(s, p, a)
+		if only_masked:
+			options = dict(seed=seed, subseed=subseed, **face_config)
+			img2img_imgage, region = process_face_detailing_crop(image, p, box, dilation, options, best_quality)
+			rx1, ry1, rx2, ry2 = region
+			x1, y1, x2, y2 = util.fix_box_size(box)
+			face_mask = Image.new('L', img2img_imgage.size, color=0)
+			dr = ImageDraw.Draw(face_mask, 'L')
+			dr.rectangle((x1 - rx1, y1 - ry1, x2 - rx1, y2 - ry1), fill=255)
+			blur = ImageFilter.GaussianBlur(3)
+			image.paste(img2img_imgage, (rx1, ry1), mask=face_mask.filter(blur))
+			continue
+
 		face_mask = Image.new('L', image.size, color=0)
 		dr = ImageDraw.Draw(face_mask, 'L')
 		dr.rectangle(box, fill=255)
 		face_mask = util.dilate_mask(face_mask, dilation)
 
-		seed, subseed = util.get_seeds(s, p, a)
 		options = dict(mask=face_mask, seed=seed, subseed=subseed, **face_config)
 		with VAEMethodOverride(hiresfix=best_quality):
 			img2img_imgage = process.process_img2img(p, image, options=options)
@@ -186,21 +201,83 @@ def process_face_detailing_inner(image, s, p, a):
 		mask = face_mask.filter(blur)
 
 		image.paste(img2img_imgage, mask=mask)
+
+	if targets:
+		image = process_face_detailing_batch(image, s, p, a, targets, dilation, best_quality)
 	devices.torch_gc()
 	return image
 
 
+def process_face_detailing_crop(image, p, box, dilation, options, best_quality):
+	padding = options.get('inpaint_full_res_padding', 32) + dilation // 2
+	region = util.get_crop_region(box, padding, options['width'], options['height'], image.size)
+	rx1, ry1, rx2, ry2 = region
+	x1, y1, x2, y2 = box
+
+	face_mask = Image.new('L', (rx2 - rx1, ry2 - ry1), color=0)
+	dr = ImageDraw.Draw(face_mask, 'L')
+	dr.rectangle((x1 - rx1, y1 - ry1, x2 - rx1, y2 - ry1), fill=255)
+	options = dict(options, mask=util.dilate_mask(face_mask, dilation))
+
+	with VAEMethodOverride(hiresfix=best_quality):
+		img2img_image = process.process_img2img(p, image.crop(region), options=options)
+	return img2img_image, region
+
+
+def process_face_detailing_batch(image, s, p, a, targets, dilation, best_quality):
+	batch_size = process.get_detailing_batch_size()
+	seed, subseed = util.get_seeds(s, p, a)
+	blur = ImageFilter.GaussianBlur(3)
+
+	for start in range(0, len(targets), batch_size):
+		chunk = targets[start:start + batch_size]
+		face_config = chunk[0][1]
+		width = face_config['width']
+		height = face_config['height']
+		padding = face_config.get('inpaint_full_res_padding', 32) + dilation // 2
+
+		regions = []
+		crops = []
+		for box, config in chunk:
+			region = util.get_crop_region(box, padding, width, height, image.size)
+			regions.append(region)
+			crops.append(image.crop(region).resize((width, height), resample=Image.LANCZOS))
+
+		options = dict(face_config)
+		options['prompt'] = [config.get('prompt', p.prompt) for box, config in chunk]
+		options['negative_prompt'] = [config.get('negative_prompt', p.negative_prompt) for box, config in chunk]
+		options['seed'] = [seed] * len(chunk)
+		options['subseed'] = [subseed] * len(chunk)
+		options['inpaint_full_res'] = 0
+		debug_print(f'Face batch {len(chunk)} ({width},{height})')
+
+		shared.state.job_count -= len(chunk) - 1
+		with VAEMethodOverride(hiresfix=best_quality):
+			results = process.process_img2img_batch(p, crops, options=options)
+
+		for (box, config), region, result in zip(chunk, regions, results):
+			rx1, ry1, rx2, ry2 = region
+			result = result.resize((rx2 - rx1, ry2 - ry1), resample=Image.LANCZOS)
+			x1, y1, x2, y2 = util.fix_box_size(box)
+			mask = Image.new('L', result.size, color=0)
+			dr = ImageDraw.Draw(mask, 'L')
+			dr.rectangle((x1 - rx1, y1 - ry1, x2 - rx1, y2 - ry1), fill=255)
+			image.paste(result, (rx1, ry1), mask=mask.filter(blur))
+
+	return image
+
+
 @timecalc
 def process_face_detailing_inner_using_yolo(image, s, p, a):
-	face_detailing_opt = a.get('module_config', {}).get('face_detailing_opt', {})
-	face_detailing = dict(a.get('module_config', {}).get('face_detailing', {}))
-	override_parameter = face_detailing_opt.get('override_parameter', False)
-	dilation = face_detailing_opt.get('dilation', 4)
-	confidence = face_detailing_opt.get('box_threshold', 0.3)
+	face_detailing_opt = a.module_config.face_detailing_opt
+	face_detailing = a.module_config.face_detailing.to_dict()
+	override_parameter = face_detailing_opt.override_parameter
+	dilation = face_detailing_opt.dilation
+	confidence = face_detailing_opt.box_threshold
 	order = face_detailing_opt.get('order_by', 'Score')
-	limit = face_detailing_opt.get('limit', 1)
-	sampler = face_detailing_opt.get('sampler', constants.sampler_default)
-	best_quality = face_detailing_opt.get('best_quality', False)
+	limit = face_detailing_opt.limit
+	sampler = face_detailing_opt.sampler
+	best_quality = face_detailing_opt.best_quality
 	max_element = shared.opts.bmab_max_detailing_element
 
 	org_size = image.size
@@ -255,6 +332,9 @@ def process_face_detailing_inner_using_yolo(image, s, p, a):
 
 	shared.state.job_count += min(limit, len(candidate))
 
+	only_masked = face_config.get('inpaint_full_res') in ('Only masked', 1)
+	batched = process.get_detailing_batch_size() > 1 and only_masked
+	targets = []
 	for idx, (size, box) in enumerate(candidate):
 		if limit != 0 and idx >= limit:
 			debug_print(f'Over limit {limit}')
@@ -281,32 +361,44 @@ def process_face_detailing_inner_using_yolo(image, s, p, a):
 		else:
 			face_config['negative_prompt'] = p.all_negative_prompts[s.index]
 
+		if batched:
+			targets.append((box, dict(face_config)))
+			continue
+
+		seed, subseed = util.get_seeds(s, p, a)
+		if only_masked:
+			options = dict(seed=seed, subseed=subseed, **face_config)
+			img2img_imgage, region = process_face_detailing_crop(image, p, box, dilation, options, best_quality)
+			image.paste(img2img_imgage, region[:2])
+			continue
+
 		face_mask = Image.new('L', image.size, color=0)
 		dr = ImageDraw.Draw(face_mask, 'L')
 		dr.rectangle(box, fill=255)
 		face_mask = util.dilate_mask(face_mask, dilation)
 
-		seed, subseed = util.get_seeds(s, p, a)
 		options = dict(mask=face_mask, seed=seed, subseed=subseed, **face_config)
 		with VAEMethodOverride(hiresfix=best_quality):
 			image = process.process_img2img(p, image, options=options)
 
+	if targets:
+		image = process_face_detailing_batch(image, s, p, a, targets, dilation, best_quality)
 	devices.torch_gc()
 	return image
 
 
 def process_hand_detailing(image, s, p, a):
-	if a['hand_detailing_enabled']:
+	if a.hand_detailing_enabled:
 		return process_hand_detailing_inner(image, s, p, a)
 	return image
 
 
 @timecalc
 def process_hand_detailing_inner(image, s, p, args):
-	hand_detailing = dict(args.get('module_config', {}).get('hand_detailing', {}))
-	hand_detailing_opt = args.get('module_config', {}).get('hand_detailing_opt', {})
-	detailing_method = hand_detailing_opt.get('detailing_method', '')
-	best_quality = hand_detailing_opt.get('best_quality', False)
+	hand_detailing = args.module_config.hand_detailing.to_dict()
+	hand_detailing_opt = args.module_config.hand_detailing_opt
+	detailing_method = hand_detailing_opt.detailing_method
+	best_quality = hand_detailing_opt.best_quality
 
 	dinosam.dino_init()
 
@@ -329,6 +421,8 @@ def process_hand_detailing_inner(image, s, p, args):
 		with VAEMethodOverride():
 			image = process.process_img2img(p, image, options=options)
 	elif detailing_method == 'each hand' or detailing_method == 'inpaint each hand':
+		batched = process.get_detailing_batch_size() > 1 and detailing_method == 'each hand'
+		pending = []
 		boxes, logits, phrases = dinosam.dino_predict(image, 'person . hand')
 		for idx, (box, logit, phrase) in enumerate(zip(boxes, logits, phrases)):
 			debug_print(float(logit), phrase)
@@ -351,7 +445,7 @@ def process_hand_detailing_inner(image, s, p, args):
 			dr.rectangle(hbox, fill=255)
 
 			options = dict(seed=-1)
-			scale = hand_detailing_opt.get('scale', -1)
+			scale = hand_detailing_opt.scale
 			if scale < 1:
 				normalize = hand_detailing_opt.get('normalize', 768)
 				if width > height:
@@ -367,6 +461,9 @@ def process_hand_detailing_inner(image, s, p, args):
 			options['height'] = h
 			debug_print(f'scale {scale} width {w} height {h}')
 			shared.state.job_count += 1
+			if batched:
+				pending.append((cropped_hand, cropped_hand_mask, (mbox[0], mbox[1]), options))
+				continue
 			with VAEMethodOverride(hiresfix=best_quality):
 				img2img_result = process.process_img2img(p, cropped_hand, options=options)
 			img2img_result = img2img_result.resize(cropped_hand.size, resample=Image.LANCZOS)
@@ -375,6 +472,7 @@ def process_hand_detailing_inner(image, s, p, args):
 			blur = ImageFilter.GaussianBlur(3)
 			cropped_hand_mask = cropped_hand_mask.filter(blur)
 			image.paste(img2img_result, (mbox[0], mbox[1]), mask=cropped_hand_mask)
+		image = process_hand_detailing_batch(image, p, pending, hiresfix=best_quality)
 	else:
 		debug_print('no such method')
 		return image
@@ -383,17 +481,17 @@ def process_hand_detailing_inner(image, s, p, args):
 
 
 def process_hand_detailing_subframe(image, s, p, args):
-	hand_detailing = dict(args.get('module_config', {}).get('hand_detailing', {}))
-	hand_detailing_opt = args.get('module_config', {}).get('hand_detailing_opt', {})
-	dilation = hand_detailing_opt.get('dilation', 0.1)
+	hand_detailing = args.module_config.hand_detailing.to_dict()
+	hand_detailing_opt = args.module_config.hand_detailing_opt
+	dilation = hand_detailing_opt.dilation
 	debug_print('dilation', dilation)
 
-	box_threshold = hand_detailing_opt.get('box_threshold', 0.3)
+	box_threshold = hand_detailing_opt.box_threshold
 	boxes, masks = get_subframe(image, dilation, box_threshold=box_threshold)
 	if not boxes:
 		return image
 
-	if not hasattr(args, 'hand_mask_image'):
+	if s.extra_image.is_recording() and not hasattr(args, 'hand_mask_image'):
 		c1 = image.copy()
 		for box, mask in zip(boxes, masks):
 			box = util.fix_box_by_scale(box, dilation)
@@ -406,6 +504,8 @@ def process_hand_detailing_subframe(image, s, p, args):
 		s.extra_image.append(c1)
 		p.hand_mask_image = c1
 
+	batched = process.get_detailing_batch_size() > 1
+	pending = []
 	for box, mask in zip(boxes, masks):
 		box = util.fix_box_by_scale(box, dilation)
 		box = util.fix_box_size(box)
@@ -415,25 +515,25 @@ def process_hand_detailing_subframe(image, s, p, args):
 		cropped = image.crop(box=box)
 		cropped_mask = mask.crop(box=box)
 
-		scale = hand_detailing_opt.get('scale', 2)
+		scale = hand_detailing_opt.scale
 
 		options = dict(mask=cropped_mask, seed=-1)
-		hand_detailing = dict(args.get('module_config', {}).get('hand_detailing', {}))
+		hand_detailing = args.module_config.hand_detailing.to_dict()
 		options.update(hand_detailing)
 		w, h = util.fix_size_by_scale(cropped.width, cropped.height, scale)
 		options['width'] = w
 		options['height'] = h
 		debug_print(f'Scale x{scale} ({cropped.width},{cropped.height}) -> ({w},{h})')
 
-		if hand_detailing_opt.get('block_overscaled_image', True):
+		if hand_detailing_opt.block_overscaled_image:
 			area_org = args.get('max_area', image.width * image.height)
 			area_scaled = w * h
 			if area_scaled > area_org:
 				debug_print(f'It is too large to process.')
-				auto_upscale = hand_detailing_opt.get('auto_upscale', True)
+				auto_upscale = hand_detailing_opt.auto_upscale
 				if not auto_upscale:
 					p.extra_generation_params['BMAB_hand_SKIP'] = f'Image too large to process {cropped.width}x{cropped.height} {w}x{h}'
-					return image
+					return process_hand_detailing_batch(image, p, pending)
 				scale = math.sqrt(area_org / (cropped.width * cropped.height))
 				w, h = util.fix_size_by_scale(cropped.width, cropped.height, scale)
 				options['width'] = w
@@ -442,8 +542,11 @@ def process_hand_detailing_subframe(image, s, p, args):
 				if scale < 1.2:
 					debug_print(f'Scale {scale} has no effect. skip!!!!!')
 					p.extra_generation_params['BMAB_hand_SKIP'] = f'{scale} < 1.2'
-					return image
+					return process_hand_detailing_batch(image, p, pending)
 		shared.state.job_count += 1
+		if batched:
+			pending.append((cropped, cropped_mask, (x1, y1), options))
+			continue
 		with VAEMethodOverride():
 			img2img_result = process.process_img2img(p, cropped, options=options)
 		img2img_result = img2img_result.resize((cropped.width, cropped.height), resample=Image.LANCZOS)
@@ -452,6 +555,34 @@ def process_hand_detailing_subframe(image, s, p, args):
 		image.paste(img2img_result, (x1, y1), mask=cropped_mask)
 		devices.torch_gc()
 
+	return process_hand_detailing_batch(image, p, pending)
+
+
+def process_hand_detailing_batch(image, p, pending, hiresfix=False):
+	if not pending:
+		return image
+
+	batch_size = process.get_detailing_batch_size()
+	buckets = {}
+	for item in pending:
+		options = item[3]
+		buckets.setdefault((options['width'], options['height']), []).append(item)
+
+	blur = ImageFilter.GaussianBlur(3)
+	for (w, h), items in buckets.items():
+		for start in range(0, len(items), batch_size):
+			chunk = items[start:start + batch_size]
+			options = dict(chunk[0][3])
+			options.pop('mask', None)
+			debug_print(f'Hand batch {len(chunk)} ({w},{h})')
+			shared.state.job_count -= len(chunk) - 1
+			with VAEMethodOverride(hiresfix=hiresfix):
+				results = process.process_img2img_batch(p, [cropped for cropped, mask, pos, opt in chunk], options=options)
+			for (cropped, mask, pos, opt), img2img_result in zip(chunk, results):
+				img2img_result = img2img_result.resize(cropped.size, resample=Image.LANCZOS)
+				image.paste(img2img_result, pos, mask=mask.filter(blur))
+			devices.torch_gc()
+
 	return image
 
 
@@ -620,61 +751,66 @@ def get_subframe(pilimg, dilation, box_threshold=0.30, text_threshold=0.20):
 
 
 def process_person_detailing(image, s, p, a):
-	if a['person_detailing_enabled']:
+	if a.person_detailing_enabled:
 		return process_person_detailing_inner(image, s, p, a)
 	return image
 
 
 def dilate_mask(mask, value):
-	return mask.filter(ImageFilter.MaxFilter(value))
+	return util.MaskROI.from_image(mask).filter(ImageFilter.MaxFilter(value), value).to_image()
 
 
 @timecalc
 def process_person_detailing_inner(image, s, p, a):
-	person_detailing_opt = a.get('module_config', {}).get('person_detailing_opt', {})
-	dilation = person_detailing_opt.get('dilation', 3)
-	area_ratio = person_detailing_opt.get('area_ratio', 0.1)
-	limit = person_detailing_opt.get('limit', 1)
-	force_one_on_one = person_detailing_opt.get('force_1:1', False)
-	background_color = person_detailing_opt.get('background_color', 1)
-	background_blur = person_detailing_opt.get('background_blur', 0)
-	best_quality = person_detailing_opt.get('best_quality', False)
+	person_detailing_opt = a.module_config.person_detailing_opt
+	dilation = person_detailing_opt.dilation
+	area_ratio = person_detailing_opt.area_ratio
+	limit = person_detailing_opt.limit
+	force_one_on_one = person_detailing_opt.force_1_1
+	background_color = person_detailing_opt.background_color
+	background_blur = person_detailing_opt.background_blur
+	best_quality = person_detailing_opt.best_quality
 	max_element = shared.opts.bmab_max_detailing_element
 
 	p.extra_generation_params['BMAB_person_option'] = util.dict_to_str(person_detailing_opt)
 
-	dinosam.dino_init()
-	boxes, logits, phrases = dinosam.dino_predict(image, 'people')
+	with instrument.stage('person_detect'):
+		dinosam.dino_init()
+		boxes, logits, phrases = dinosam.dino_predict(image, 'people')
 	debug_print(phrases)
 
 	org_size = image.size
 	debug_print('size', org_size)
 
-	i2i_config = dict(a.get('module_config', {}).get('person_detailing', {}))
+	i2i_config = a.module_config.person_detailing.to_dict()
 	debug_print(f'Max element {max_element}')
 
 	shared.state.job_count += min(limit, len(boxes))
 
-	processed = []
-	for idx, (box, logit, phrase) in enumerate(zip(boxes, logits, phrases)):
-		if limit != 0 and idx >= limit:
-			debug_print(f'Over limit {limit}')
-			break
+	count = len(boxes)
+	if limit != 0 and count > limit:
+		debug_print(f'Over limit {limit}')
+		count = limit
+	if max_element != 0 and count > max_element:
+		debug_print(f'Over limit MAX Element {max_element}')
+		count = max_element
 
-		if max_element != 0 and idx >= max_element:
-			debug_print(f'Over limit MAX Element {max_element}')
-			break
+	with instrument.stage('person_sam'):
+		masks = dinosam.sam_predict_boxes(image, boxes[:count])
 
+	batched = process.get_detailing_batch_size() > 1
+	pending = []
+	slots = []
+	processed = []
+	for box, logit, phrase, mask in zip(boxes, logits, phrases, masks):
 		debug_print('render', phrase, float(logit))
 		box2 = util.fix_box_size(box)
 		x1, y1, x2, y2 = box2
 
-		mask = dinosam.sam_predict_box(image, box)
-		mask = util.dilate_mask(mask, dilation)
-		cropped_mask = mask.crop(box=box).convert('L')
+		cropped_mask = util.MaskROI.from_image(mask).dilate(dilation).crop(box)
 		cropped = image.crop(box=box)
 
-		scale = person_detailing_opt.get('scale', 4)
+		scale = person_detailing_opt.scale
 		if force_one_on_one:
 			scale = 1.0
 
@@ -696,12 +832,12 @@ def process_person_detailing_inner(image, s, p, a):
 		h = int(cropped.height * scale)
 		debug_print(f'Trying x{scale} ({cropped.width},{cropped.height}) -> ({w},{h})')
 
-		if scale > 1 and person_detailing_opt.get('block_overscaled_image', True):
+		if scale > 1 and person_detailing_opt.block_overscaled_image:
 			area_org = a.get('max_area', image.width * image.height)
 			area_scaled = w * h
 			if area_scaled > area_org:
 				debug_print(f'It is too large to process.')
-				auto_upscale = person_detailing_opt.get('auto_upscale', True)
+				auto_upscale = person_detailing_opt.auto_upscale
 				if not auto_upscale:
 					if background_color != 1:
 						processed.append((cropped, (x1, y1), cropped_mask))
@@ -725,27 +861,66 @@ def process_person_detailing_inner(image, s, p, a):
 		options['inpaint_full_res'] = 1
 		options['inpaint_full_res'] = 32
 
-		with VAEMethodOverride(hiresfix=best_quality):
+		if batched:
+			slots.append(len(processed))
+			processed.append(None)
+			pending.append((cropped, (x1, y1), cropped_mask, options))
+			continue
+
+		with instrument.stage('person_img2img'), VAEMethodOverride(hiresfix=best_quality):
 			img2img_result = process.process_img2img(p, cropped, options=options)
 		img2img_result = img2img_result.resize(cropped.size, resample=Image.LANCZOS)
 		blur = ImageFilter.GaussianBlur(3)
 		cropped_mask = cropped_mask.filter(blur)
 		processed.append((img2img_result, (x1, y1), cropped_mask))
 
-	if background_color != 1:
-		enhancer = ImageEnhance.Color(image)
-		image = enhancer.enhance(background_color)
-	if background_blur > 3:
-		blur = ImageFilter.GaussianBlur(background_blur)
-		image = image.filter(blur)
+	if pending:
+		with instrument.stage('person_img2img'):
+			for slot, result in zip(slots, process_person_detailing_batch(p, pending, best_quality)):
+				processed[slot] = result
+
+	with instrument.stage('person_composite'):
+		if background_color != 1:
+			enhancer = ImageEnhance.Color(image)
+			image = enhancer.enhance(background_color)
+		if background_blur > 3:
+			blur = ImageFilter.GaussianBlur(background_blur)
+			image = image.filter(blur)
 
-	for img2img_result, pos, cropped_mask in processed:
-		image.paste(img2img_result, pos, mask=cropped_mask)
+		for img2img_result, pos, cropped_mask in processed:
+			image.paste(img2img_result, pos, mask=cropped_mask)
 
 	devices.torch_gc()
 	return image
 
 
+def process_person_detailing_batch(p, pending, best_quality):
+	batch_size = process.get_detailing_batch_size()
+	buckets = {}
+	for idx, item in enumerate(pending):
+		options = item[3]
+		buckets.setdefault((options['width'], options['height']), []).append(idx)
+
+	processed = [None] * len(pending)
+	blur = ImageFilter.GaussianBlur(3)
+	for (w, h), indices in buckets.items():
+		for start in range(0, len(indices), batch_size):
+			chunk = indices[start:start + batch_size]
+			options = dict(pending[chunk[0]][3])
+			options.pop('mask', None)
+			debug_print(f'Person batch {len(chunk)} ({w},{h})')
+			shared.state.job_count -= len(chunk) - 1
+			with VAEMethodOverride(hiresfix=best_quality):
+				results = process.process_img2img_batch(p, [pending[idx][0] for idx in chunk], options=options)
+			for idx, img2img_result in zip(chunk, results):
+				cropped, pos, mask, opt = pending[idx]
+				img2img_result = img2img_result.resize(cropped.size, resample=Image.LANCZOS)
+				processed[idx] = (img2img_result, pos, mask.filter(blur))
+			devices.torch_gc()
+
+	return processed
+
+
 
 
 
@@ -1,11 +1,14 @@
 import cv2
 import os
+import threading
 import numpy as np
 
 import torch
 
+from collections import OrderedDict
 from PIL import Image
 from groundingdino.util.inference import load_model, predict
+from modules import shared
 from modules.paths import models_path
 from modules.safe import unsafe_torch_load, load
 from modules.devices import device, torch_gc
@@ -15,45 +18,162 @@ from segment_anything import SamPredictor
 from segment_anything import sam_model_registry
 import groundingdino.datasets.transforms as T
 
+from sd_bmab import util, constants, cache, instrument
+
 bmab_model_path = os.path.join(models_path, "bmab")
+dino_model_file = '%s/groundingdino_swint_ogc.pth' % bmab_model_path
+sam_model_file = '%s/sam_vit_b_01ec64.pth' % bmab_model_path
 
 dino_model = None
 sam_model = None
 
+sam_embeddings = OrderedDict()
+sam_embeddings_limit = 4
+
+release_lock = threading.Lock()
+release_timer = None
+
+
+class DetectionSession(object):
+
+	def __init__(self) -> None:
+		super().__init__()
+		self.key = None
+		self.size = None
+		self.source = None
+		self.image = None
+		self.features = None
+		self.results = {}
+		self.active = False
+
+	def prepare(self, pilimg):
+		key = util.image_hash(pilimg)
+		if key != self.key:
+			self.reset()
+			self.source = pilimg
+			self.size = pilimg.size
+			self.key = key
+		return self.key
+
+	def get_image(self):
+		if self.image is None:
+			transform = T.Compose(
+				[
+					T.RandomResize([800], max_size=1333),
+					T.ToTensor(),
+					T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
+				]
+			)
+			self.image, _ = transform(self.source.convert('RGB'), None)
+		return self.image
+
+	def reset(self):
+		self.key = None
+		self.size = None
+		self.source = None
+		self.image = None
+		self.features = None
+		self.results = {}
+
+
+detection_session = DetectionSession()
+
+
+def cache_backbone(model):
+	backbone = model.backbone
+	forward = backbone.forward
+
+	def cached_forward(samples):
+		if not detection_session.active:
+			return forward(samples)
+		if detection_session.features is None:
+			detection_session.features = forward(samples)
+		features, poss = detection_session.features
+		return list(features), list(poss)
+
+	backbone.forward = cached_forward
+
 
 def dino_init():
 	global dino_model
 	if not dino_model:
-		dino_model = load_model('%s/GroundingDINO_SwinT_OGC.py' % bmab_model_path, '%s/groundingdino_swint_ogc.pth' % bmab_model_path)
+		with instrument.timed('load'):
+			dino_model = load_model('%s/GroundingDINO_SwinT_OGC.py' % bmab_model_path, dino_model_file)
+		cache_backbone(dino_model)
 	return dino_model
 
 
 def dino_predict(pilimg, prompt, box_threahold=0.35, text_threshold=0.25):
-	transform = T.Compose(
-		[
-			T.RandomResize([800], max_size=1333),
-			T.ToTensor(),
-			T.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225]),
-		]
-	)
-	img = pilimg.convert('RGB')
-	image_source = np.asarray(img)
-	image, _ = transform(img, None)
+	image_key = detection_session.prepare(pilimg)
+
+	key = (prompt, box_threahold, text_threshold)
+	if key in detection_session.results:
+		boxes, logits, phrases = detection_session.results[key]
+		return boxes.copy(), logits, list(phrases)
+
+	disk_key = None
+	if cache.is_enabled():
+		disk_key = cache.make_key('dino', image_key, cache.model_hash(dino_model_file), prompt, box_threahold, text_threshold)
+		data = cache.detection_cache.get(disk_key)
+		if data is not None:
+			annotated_frame, logits, phrases = data['boxes'], torch.from_numpy(data['logits']), [str(x) for x in data['phrases']]
+			detection_session.results[key] = (annotated_frame, logits, phrases)
+			return annotated_frame.copy(), logits, list(phrases)
 
 	model = dino_init()
-	boxes, logits, phrases = predict(
-		model=model,
-		image=image,
-		caption=prompt,
-		box_threshold=box_threahold,
-		text_threshold=text_threshold
-	)
-
-	h, w, _ = image_source.shape
+	detection_session.active = True
+	try:
+		with instrument.timed('inference'):
+			boxes, logits, phrases = predict(
+				model=model,
+				image=detection_session.get_image(),
+				caption=prompt,
+				box_threshold=box_threahold,
+				text_threshold=text_threshold
+			)
+	finally:
+		detection_session.active = False
+
+	w, h = detection_session.size
 	boxes = boxes * torch.Tensor([w, h, w, h])
 	annotated_frame = box_convert(boxes=boxes, in_fmt='cxcywh', out_fmt='xyxy').numpy()
+	detection_session.results[key] = (annotated_frame, logits, phrases)
+	if disk_key is not None:
+		cache.detection_cache.put(disk_key, boxes=annotated_frame, logits=logits.cpu().numpy(), phrases=np.array(phrases, dtype=str))
+
+	return annotated_frame.copy(), logits, list(phrases)
+
+
+class PersonRatioEstimator(object):
+
+	def __init__(self, limit=4) -> None:
+		super().__init__()
+		self.ratios = OrderedDict()
+		self.limit = limit
+
+	def estimate(self, pilimg):
+		key = util.image_hash(pilimg)
+		if key in self.ratios:
+			self.ratios.move_to_end(key)
+			return self.ratios[key]
+
+		dino_init()
+		boxes, logits, phrases = dino_predict(pilimg, 'person')
+		boxes = np.asarray(boxes).reshape(-1, 4)
+		ratio = 0
+		if len(boxes) > 0:
+			areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+			idx = int(np.argmax(areas))
+			if areas[idx] > 0:
+				ratio = (boxes[idx, 3] - boxes[idx, 1]) / pilimg.height
 
-	return annotated_frame, logits, phrases
+		self.ratios[key] = ratio
+		while len(self.ratios) > self.limit:
+			self.ratios.popitem(last=False)
+		return ratio
+
+
+person_ratio_estimator = PersonRatioEstimator()
 
 
 def sam_init():
@@ -62,63 +182,131 @@ def sam_init():
 	global sam_model
 	if not sam_model:
 		torch.load = unsafe_torch_load
-		sam_model = sam_model_registry[MODEL_TYPE](checkpoint='%s/sam_vit_b_01ec64.pth' % bmab_model_path)
-		sam_model.to(device=device)
-		sam_model.eval()
+		with instrument.timed('load'):
+			sam_model = sam_model_registry[MODEL_TYPE](checkpoint=sam_model_file)
+			sam_model.to(device=device)
+			sam_model.eval()
 		torch.load = load
 
 	return sam_model
 
 
-def sam_predict(pilimg, boxes):
+def sam_predictor(pilimg, key=None):
 	sam = sam_init()
 
 	mask_predictor = SamPredictor(sam)
 
-	numpy_image = np.array(pilimg)
-	opencv_image = cv2.cvtColor(numpy_image, cv2.COLOR_RGB2BGR)
-	mask_predictor.set_image(opencv_image)
-
-	result = Image.new('L', pilimg.size, 0)
-	for box in boxes:
-		x1, y1, x2, y2 = box
-
-		box = np.array([int(x1), int(y1), int(x2), int(y2)])
-		masks, scores, logits = mask_predictor.predict(
-			box=box,
+	if key is None:
+		key = util.image_hash(pilimg)
+	embedding = sam_embeddings.get(key)
+	if embedding is None:
+		numpy_image = np.array(pilimg)
+		opencv_image = cv2.cvtColor(numpy_image, cv2.COLOR_RGB2BGR)
+		with instrument.timed('inference'):
+			mask_predictor.set_image(opencv_image)
+		sam_embeddings[key] = (mask_predictor.features, mask_predictor.original_size, mask_predictor.input_size)
+		while len(sam_embeddings) > sam_embeddings_limit:
+			sam_embeddings.popitem(last=False)
+	else:
+		sam_embeddings.move_to_end(key)
+		mask_predictor.features, mask_predictor.original_size, mask_predictor.input_size = embedding
+		mask_predictor.is_image_set = True
+
+	return mask_predictor
+
+
+def sam_predict_boxes(pilimg, boxes):
+	if len(boxes) == 0:
+		return []
+
+	int_boxes = [[int(x) for x in box] for box in boxes]
+	image_key = util.image_hash(pilimg)
+	disk_key = None
+	if cache.is_enabled():
+		disk_key = cache.make_key('sam', image_key, cache.model_hash(sam_model_file), int_boxes)
+		data = cache.detection_cache.get(disk_key)
+		if data is not None:
+			return [Image.fromarray(mask) for mask in cache.unpack_masks(data)]
+
+	mask_predictor = sam_predictor(pilimg, key=image_key)
+
+	input_boxes = torch.tensor(int_boxes, dtype=torch.float, device=mask_predictor.device)
+	input_boxes = mask_predictor.transform.apply_boxes_torch(input_boxes, mask_predictor.original_size)
+	with instrument.timed('inference'):
+		masks, scores, logits = mask_predictor.predict_torch(
+			point_coords=None,
+			point_labels=None,
+			boxes=input_boxes,
 			multimask_output=False
 		)
 
-		mask = Image.fromarray(masks[0])
-		result.paste(mask, mask=mask)
-
-	return result
+	masks = masks.cpu().numpy()[:, 0]
+	if disk_key is not None:
+		cache.detection_cache.put(disk_key, **cache.pack_masks(masks))
 
+	return [Image.fromarray(mask) for mask in masks]
 
-def sam_predict_box(pilimg, box):
-	sam = sam_init()
 
-	mask_predictor = SamPredictor(sam)
-
-	numpy_image = np.array(pilimg)
-	opencv_image = cv2.cvtColor(numpy_image, cv2.COLOR_RGB2BGR)
-	mask_predictor.set_image(opencv_image)
+def sam_predict(pilimg, boxes):
+	result = Image.new('L', pilimg.size, 0)
+	for mask in sam_predict_boxes(pilimg, boxes):
+		result.paste(mask, mask=mask)
 
-	x1, y1, x2, y2 = box
-	box = np.array([int(x1), int(y1), int(x2), int(y2)])
+	return result
 
-	masks, scores, logits = mask_predictor.predict(
-		box=box,
-		multimask_output=False
-	)
 
-	return Image.fromarray(masks[0])
+def sam_predict_box(pilimg, box):
+	return sam_predict_boxes(pilimg, [box])[0]
 
 
 def release():
-	global dino_model
-	dino_model = None
-	global sam_model
-	sam_model = None
-	torch_gc()
-
+	global release_timer
+	with release_lock:
+		if release_timer is not None:
+			release_timer.cancel()
+			release_timer = None
+		global dino_model
+		dino_model = None
+		global sam_model
+		sam_model = None
+		sam_embeddings.clear()
+		detection_session.reset()
+		util.ultralytics_release()
+		torch_gc()
+
+
+def cancel_release():
+	global release_timer
+	with release_lock:
+		if release_timer is not None:
+			release_timer.cancel()
+			release_timer = None
+
+
+def schedule_release(timeout):
+	global release_timer
+	with release_lock:
+		if release_timer is not None:
+			release_timer.cancel()
+		release_timer = threading.Timer(timeout, release)
+		release_timer.daemon = True
+		release_timer.start()
+
+
+def is_vram_pressure():
+	if not torch.cuda.is_available():
+		return False
+	free, total = torch.cuda.mem_get_info()
+	return free * 100 / total < shared.opts.data.get('bmab_model_min_free_vram', 20)
+
+
+def release_by_policy():
+	policy = shared.opts.data.get('bmab_model_residency', constants.model_residency_default)
+	if policy == constants.model_residency_always:
+		return
+	if policy == constants.model_residency_idle:
+		schedule_release(shared.opts.data.get('bmab_model_idle_timeout', 300))
+		return
+	if policy == constants.model_residency_vram and not is_vram_pressure():
+		return
+	release()
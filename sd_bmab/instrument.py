@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import threading
+import torch
+
+from contextlib import contextmanager
+
+from modules import shared
+
+try:
+	import psutil
+except ImportError:
+	psutil = None
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+
+write_lock = threading.Lock()
+stack = []
+records = []
+sampler = None
+sample_interval = 0.05
+
+
+class StageRecord(object):
+
+	def __init__(self, name, depth) -> None:
+		super().__init__()
+		self.name = name
+		self.depth = depth
+		self.start = time.time()
+		self.wall = 0
+		self.load = 0
+		self.inference = 0
+		self.img2img = 0
+		self.peak_rss = 0
+		self.peak_device = 0
+		self.device_start = 0
+		self.device_delta = 0
+
+	def to_dict(self):
+		return {
+			'stage': self.name,
+			'depth': self.depth,
+			'wall': round(self.wall, 4),
+			'load': round(self.load, 4),
+			'inference': round(self.inference, 4),
+			'img2img': self.img2img,
+			'peak_rss_mb': round(self.peak_rss / 1048576, 1),
+			'rss_scope': get_rss_scope(),
+			'peak_device_mb': round(self.peak_device / 1048576, 1),
+			'device_delta_mb': round(self.device_delta / 1048576, 1),
+		}
+
+
+def get_rss():
+	if psutil is not None:
+		return psutil.Process(os.getpid()).memory_info().rss
+	if resource is not None:
+		# high-water mark of the whole process, in bytes on macOS and KiB elsewhere
+		maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		return maxrss if sys.platform == 'darwin' else maxrss * 1024
+	return 0
+
+
+def get_rss_scope():
+	return 'stage' if psutil is not None else 'process'
+
+
+def is_tracing():
+	return bool(shared.opts.data.get('bmab_trace_file', ''))
+
+
+def get_device_allocated():
+	if torch.cuda.is_available():
+		return torch.cuda.memory_allocated()
+	return 0
+
+
+def get_device_peak():
+	# read only, the peak counters belong to webui's memory monitor and are never reset here
+	if torch.cuda.is_available():
+		return torch.cuda.max_memory_allocated()
+	return 0
+
+
+def update_peaks():
+	rss = get_rss()
+	device = get_device_allocated()
+	for record in list(stack):
+		record.peak_rss = max(record.peak_rss, rss)
+		record.peak_device = max(record.peak_device, device)
+
+
+class RSSSampler(threading.Thread):
+
+	def __init__(self) -> None:
+		super().__init__(name='bmab-rss-sampler', daemon=True)
+		self.stopped = threading.Event()
+
+	def run(self):
+		while not self.stopped.wait(sample_interval):
+			update_peaks()
+
+
+def start_sampler():
+	global sampler
+	if psutil is not None and sampler is None:
+		sampler = RSSSampler()
+		sampler.start()
+
+
+def stop_sampler():
+	global sampler
+	if sampler is not None:
+		sampler.stopped.set()
+		sampler = None
+
+
+def begin():
+	stack.clear()
+	records.clear()
+
+
+@contextmanager
+def stage(name):
+	tracing = is_tracing()
+	record = StageRecord(name, len(stack))
+	if tracing:
+		update_peaks()
+		record.device_start = get_device_allocated()
+		device_peak = get_device_peak()
+	stack.append(record)
+	records.append(record)
+	if tracing:
+		start_sampler()
+	try:
+		yield record
+	finally:
+		if tracing:
+			update_peaks()
+			# the process peak only moves when this stage set a new high-water mark
+			device_peak_after = get_device_peak()
+			if device_peak_after > device_peak:
+				record.peak_device = max(record.peak_device, device_peak_after)
+			record.device_delta = get_device_allocated() - record.device_start
+		stack.remove(record)
+		if not stack:
+			stop_sampler()
+		record.wall = time.time() - record.start
+		if shared.opts.bmab_debug_print:
+			print(f'{name} {record.wall:.2f} sec')
+
+
+@contextmanager
+def timed(kind):
+	start = time.time()
+	try:
+		yield
+	finally:
+		elapsed = time.time() - start
+		for record in stack:
+			setattr(record, kind, getattr(record, kind) + elapsed)
+
+
+def count(kind, value=1):
+	for record in stack:
+		setattr(record, kind, getattr(record, kind) + value)
+
+
+def end(p, index=0):
+	trace_file = shared.opts.data.get('bmab_trace_file', '')
+	if trace_file:
+		seed = p.all_seeds[index] if index < len(getattr(p, 'all_seeds', [])) else getattr(p, 'seed', -1)
+		now = time.time()
+		with write_lock, open(trace_file, 'a') as f:
+			for record in records:
+				line = dict(time=now, index=index, seed=seed, **record.to_dict())
+				f.write(json.dumps(line) + '\n')
+
+	if shared.opts.data.get('bmab_trace_infotext', False):
+		summary = ', '.join(f'{record.name} {record.wall:.2f}s' for record in records if record.depth == 0)
+		if summary:
+			p.extra_generation_params['BMAB timing'] = summary
+
+	records.clear()
@@ -3,103 +3,275 @@ import json
 from sd_bmab import constants
 
 
-class Parameters(object):
+preset_cache = {}
+
+
+def load_json_cached(json_file):
+	mtime = os.path.getmtime(json_file)
+	cached = preset_cache.get(json_file)
+	if cached is None or cached[0] != mtime:
+		with open(json_file) as f:
+			config = json.load(f)
+		print('Loading config', json.dumps(config, indent=2))
+		cached = (mtime, config)
+		preset_cache[json_file] = cached
+	return Parameters.copy_dict(cached[1])
+
+
+params = (
+	('enabled', False),
+	('contrast', 1),
+	('brightness', 1),
+	('sharpeness', 1),
+	('color_saturation', 1),
+	('color_temperature', 0),
+	('noise_alpha', 0),
+	('noise_alpha_final', 0),
+	('edge_flavor_enabled', False),
+	('edge_low_threadhold', 50),
+	('edge_high_threadhold', 200),
+	('edge_strength', 0.5),
+	('input_image', None),
+	('blend_enabled', False),
+	('blend_alpha', 1),
+	('dino_detect_enabled', False),
+	('dino_prompt', ''),
+	('person_detailing_enabled', False),
+	('module_config.person_detailing_opt.best_quality', False),
+	('module_config.person_detailing_opt.force_1:1', False),
+	('module_config.person_detailing_opt.block_overscaled_image', True),
+	('module_config.person_detailing_opt.auto_upscale', True),
+	('module_config.person_detailing_opt.scale', 4),
+	('module_config.person_detailing_opt.dilation', 2),
+	('module_config.person_detailing_opt.area_ratio', 0.1),
+	('module_config.person_detailing_opt.limit', 1),
+	('module_config.person_detailing_opt.background_color', 1),
+	('module_config.person_detailing_opt.background_blur', 0),
+	('module_config.person_detailing.denoising_strength', 0.4),
+	('module_config.person_detailing.cfg_scale', 7),
+	('face_detailing_enabled', False),
+	('face_detailing_before_hiresfix_enabled', False),
+	('module_config.face_detailing_opt.best_quality', False),
+	('module_config.face_detailing_opt.sort_by', 'Score'),
+	('module_config.face_detailing_opt.limit', 1),
+	('module_config.face_detailing_opt.prompt0', ''),
+	('module_config.face_detailing_opt.negative_prompt0', ''),
+	('module_config.face_detailing_opt.prompt1', ''),
+	('module_config.face_detailing_opt.negative_prompt1', ''),
+	('module_config.face_detailing_opt.prompt2', ''),
+	('module_config.face_detailing_opt.negative_prompt2', ''),
+	('module_config.face_detailing_opt.prompt3', ''),
+	('module_config.face_detailing_opt.negative_prompt3', ''),
+	('module_config.face_detailing_opt.prompt4', ''),
+	('module_config.face_detailing_opt.negative_prompt4', ''),
+	('module_config.face_detailing_opt.override_parameter', False),
+	('module_config.face_detailing.width', 512),
+	('module_config.face_detailing.height', 512),
+	('module_config.face_detailing.cfg_scale', 7),
+	('module_config.face_detailing.steps', 20),
+	('module_config.face_detailing.mask_blur', 4),
+	('module_config.face_detailing_opt.sampler', constants.sampler_default),
+	('module_config.face_detailing.inpaint_full_res', 'Only masked'),
+	('module_config.face_detailing.inpaint_full_res_padding', 32),
+	('module_config.face_detailing.denoising_strength', 0.4),
+	('module_config.face_detailing_opt.dilation', 4),
+	('module_config.face_detailing_opt.box_threshold', 0.3),
+	('module_config.face_detailing_opt.detection_model', 'GroundingDINO'),
+	('hand_detailing_enabled', False),
+	('module_config.hand_detailing_opt.block_overscaled_image', True),
+	('module_config.hand_detailing_opt.best_quality', False),
+	('module_config.hand_detailing_opt.detailing_method', 'subframe'),
+	('module_config.hand_detailing.prompt', ''),
+	('module_config.hand_detailing.negative_prompt', ''),
+	('module_config.hand_detailing.denoising_strength', 0.4),
+	('module_config.hand_detailing.cfg_scale', 7),
+	('module_config.hand_detailing_opt.auto_upscale', True),
+	('module_config.hand_detailing_opt.scale', 2),
+	('module_config.hand_detailing_opt.box_threshold', 0.3),
+	('module_config.hand_detailing_opt.dilation', 0.1),
+	('module_config.hand_detailing.inpaint_full_res', 'Whole picture'),
+	('module_config.hand_detailing.inpaint_full_res_padding', 32),
+	('module_config.hand_detailing_opt.additional_parameter', ''),
+	('resize_by_person_enabled', False),
+	('module_config.resize_by_person_opt.mode', constants.resize_mode_default),
+	('module_config.resize_by_person_opt.scale', 0.85),
+	('module_config.resize_by_person_opt.denoising_strength', 0.4),
+	('module_config.resize_by_person_opt.dilation', 10),
+	('upscale_enabled', False),
+	('detailing_after_upscale', True),
+	('upscaler_name', 'None'),
+	('upscale_ratio', 1.5),
+	('module_config.controlnet.enabled', False),
+	('module_config.controlnet.noise', False),
+	('module_config.controlnet.noise_strength', 0.7),
+	('config_file', ''),
+	('preset', 'None'),
+)
+
+
+ext_params = (
+	('hand_detailing_before_hiresfix_enabled', False),
+)
+
+
+runtime_params = ('max_area', 'upscale_limit', 'current_prompt')
+
+
+def attribute_name(key):
+	return key.replace(':', '_').replace(' ', '_')
+
+
+def validate(key, default, value):
+	if isinstance(default, bool):
+		return bool(value)
+	if isinstance(default, (int, float)):
+		try:
+			number = float(value)
+		except (TypeError, ValueError):
+			print(f'Invalid value {value!r} for {key}. Use default {default}.')
+			return default
+		if isinstance(default, int) and number.is_integer():
+			return int(number)
+		return number
+	if isinstance(default, str):
+		if value is None:
+			return default
+		return value if isinstance(value, (str, int, float)) else str(value)
+	return value
+
+
+def merge_dict(d, other):
+	for key, value in other.items():
+		if isinstance(value, dict) and isinstance(d.get(key), dict):
+			merge_dict(d[key], value)
+		elif isinstance(value, dict):
+			d[key] = Parameters.copy_dict(value)
+		else:
+			d[key] = value
+
+
+class ConfigSection(object):
+	__slots__ = ('extra',)
+
+	_fields = {}
+	_defaults = ()
+	_sections = {}
+	_schema = {}
+
 	def __init__(self) -> None:
 		super().__init__()
+		self.extra = {}
+		for attr, default in self._defaults:
+			setattr(self, attr, default)
+		for attr, section in self._sections.items():
+			setattr(self, attr, section())
+
+	def get(self, key, default=None):
+		attr = self._fields.get(key)
+		if attr is None:
+			return self.extra.get(key, default)
+		return getattr(self, attr, default)
+
+	def __getitem__(self, key):
+		attr = self._fields.get(key)
+		if attr is None:
+			return self.extra[key]
+		try:
+			return getattr(self, attr)
+		except AttributeError:
+			raise KeyError(key)
+
+	def __setitem__(self, key, value):
+		attr = self._fields.get(key)
+		if attr is None:
+			self.extra[key] = value
+		else:
+			setattr(self, attr, value)
+
+	def __contains__(self, key):
+		attr = self._fields.get(key)
+		if attr is None:
+			return key in self.extra
+		return hasattr(self, attr)
+
+	def keys(self):
+		keys = [key for key, attr in self._fields.items() if hasattr(self, attr)]
+		keys.extend(self.extra.keys())
+		return keys
 
-		self.params = [
-			('enabled', False),
-			('contrast', 1),
-			('brightness', 1),
-			('sharpeness', 1),
-			('color_saturation', 1),
-			('color_temperature', 0),
-			('noise_alpha', 0),
-			('noise_alpha_final', 0),
-			('edge_flavor_enabled', False),
-			('edge_low_threadhold', 50),
-			('edge_high_threadhold', 200),
-			('edge_strength', 0.5),
-			('input_image', None),
-			('blend_enabled', False),
-			('blend_alpha', 1),
-			('dino_detect_enabled', False),
-			('dino_prompt', ''),
-			('person_detailing_enabled', False),
-			('module_config.person_detailing_opt.best_quality', False),
-			('module_config.person_detailing_opt.force_1:1', False),
-			('module_config.person_detailing_opt.block_overscaled_image', True),
-			('module_config.person_detailing_opt.auto_upscale', True),
-			('module_config.person_detailing_opt.scale', 4),
-			('module_config.person_detailing_opt.dilation', 2),
-			('module_config.person_detailing_opt.area_ratio', 0.1),
-			('module_config.person_detailing_opt.limit', 1),
-			('module_config.person_detailing_opt.background_color', 1),
-			('module_config.person_detailing_opt.background_blur', 0),
-			('module_config.person_detailing.denoising_strength', 0.4),
-			('module_config.person_detailing.cfg_scale', 7),
-			('face_detailing_enabled', False),
-			('face_detailing_before_hiresfix_enabled', False),
-			('module_config.face_detailing_opt.best_quality', False),
-			('module_config.face_detailing_opt.sort_by', 'Score'),
-			('module_config.face_detailing_opt.limit', 1),
-			('module_config.face_detailing_opt.prompt0', ''),
-			('module_config.face_detailing_opt.negative_prompt0', ''),
-			('module_config.face_detailing_opt.prompt1', ''),
-			('module_config.face_detailing_opt.negative_prompt1', ''),
-			('module_config.face_detailing_opt.prompt2', ''),
-			('module_config.face_detailing_opt.negative_prompt2', ''),
-			('module_config.face_detailing_opt.prompt3', ''),
-			('module_config.face_detailing_opt.negative_prompt3', ''),
-			('module_config.face_detailing_opt.prompt4', ''),
-			('module_config.face_detailing_opt.negative_prompt4', ''),
-			('module_config.face_detailing_opt.override_parameter', False),
-			('module_config.face_detailing.width', 512),
-			('module_config.face_detailing.height', 512),
-			('module_config.face_detailing.cfg_scale', 7),
-			('module_config.face_detailing.steps', 20),
-			('module_config.face_detailing.mask_blur', 4),
-			('module_config.face_detailing_opt.sampler', constants.sampler_default),
-			('module_config.face_detailing.inpaint_full_res', 'Only masked'),
-			('module_config.face_detailing.inpaint_full_res_padding', 32),
-			('module_config.face_detailing.denoising_strength', 0.4),
-			('module_config.face_detailing_opt.dilation', 4),
-			('module_config.face_detailing_opt.box_threshold', 0.3),
-			('module_config.face_detailing_opt.detection_model', 'GroundingDINO'),
-			('hand_detailing_enabled', False),
-			('module_config.hand_detailing_opt.block_overscaled_image', True),
-			('module_config.hand_detailing_opt.best_quality', False),
-			('module_config.hand_detailing_opt.detailing_method', 'subframe'),
-			('module_config.hand_detailing.prompt', ''),
-			('module_config.hand_detailing.negative_prompt', ''),
-			('module_config.hand_detailing.denoising_strength', 0.4),
-			('module_config.hand_detailing.cfg_scale', 7),
-			('module_config.hand_detailing_opt.auto_upscale', True),
-			('module_config.hand_detailing_opt.scale', 2),
-			('module_config.hand_detailing_opt.box_threshold', 0.3),
-			('module_config.hand_detailing_opt.dilation', 0.1),
-			('module_config.hand_detailing.inpaint_full_res', 'Whole picture'),
-			('module_config.hand_detailing.inpaint_full_res_padding', 32),
-			('module_config.hand_detailing_opt.additional_parameter', ''),
-			('resize_by_person_enabled', False),
-			('module_config.resize_by_person_opt.mode', constants.resize_mode_default),
-			('module_config.resize_by_person_opt.scale', 0.85),
-			('module_config.resize_by_person_opt.denoising_strength', 0.4),
-			('module_config.resize_by_person_opt.dilation', 10),
-			('upscale_enabled', False),
-			('detailing_after_upscale', True),
-			('upscaler_name', 'None'),
-			('upscale_ratio', 1.5),
-			('module_config.controlnet.enabled', False),
-			('module_config.controlnet.noise', False),
-			('module_config.controlnet.noise_strength', 0.7),
-			('config_file', ''),
-			('preset', 'None'),
-		]
-
-		self.ext_params = [
-			('hand_detailing_before_hiresfix_enabled', False),
-		]
+	def items(self):
+		return [(key, self[key]) for key in self.keys()]
+
+	def update(self, d):
+		for key, value in d.items():
+			current = self.get(key)
+			if isinstance(value, dict) and isinstance(current, ConfigSection):
+				current.update(value)
+			elif isinstance(value, dict) and isinstance(current, dict):
+				merge_dict(current, value)
+			elif isinstance(value, dict):
+				self[key] = Parameters.copy_dict(value)
+			elif key in self._schema:
+				self[key] = validate(key, self._schema[key], value)
+			else:
+				self[key] = value
+
+	def copy(self):
+		other = self.__class__.__new__(self.__class__)
+		other.extra = Parameters.copy_dict(self.extra)
+		for attr in self._fields.values():
+			if hasattr(self, attr):
+				value = getattr(self, attr)
+				setattr(other, attr, value.copy() if isinstance(value, ConfigSection) else value)
+		return other
+
+	def to_dict(self):
+		return {key: value.to_dict() if isinstance(value, ConfigSection) else value for key, value in self.items()}
+
+
+def compile_section(name, entries, runtime=()):
+	fields = {}
+	defaults = []
+	schema = {}
+	children = {}
+	for key, default in entries:
+		head, _, tail = key.partition('.')
+		if tail:
+			if head not in children:
+				fields[head] = attribute_name(head)
+				children[head] = []
+			children[head].append((tail, default))
+		else:
+			fields[head] = attribute_name(head)
+			defaults.append((fields[head], default))
+			schema[head] = default
+	for key in runtime:
+		fields[key] = attribute_name(key)
+
+	sections = {fields[key]: compile_section(key, sub) for key, sub in children.items()}
+	classname = ''.join(x.capitalize() for x in name.split('_'))
+	return type(classname, (ConfigSection,), {
+		'__slots__': tuple(fields.values()),
+		'_fields': fields,
+		'_defaults': tuple(defaults),
+		'_sections': sections,
+		'_schema': schema,
+	})
+
+
+Config = compile_section('config', params + ext_params, runtime_params)
+
+arg_targets = tuple(
+	(tuple(attribute_name(x) for x in key.split('.')[:-1]), attribute_name(key.split('.')[-1]), key, default)
+	for key, default in params
+)
+
+
+class Parameters(object):
+	def __init__(self) -> None:
+		super().__init__()
+		self.params = params
+		self.ext_params = ext_params
 
 	@staticmethod
 	def get_dict_from_args(args, d):
@@ -120,6 +292,10 @@ class Parameters(object):
 			cur[key] = value
 		return ar
 
+	@staticmethod
+	def copy_dict(d):
+		return {k: Parameters.copy_dict(v) if isinstance(v, dict) else v for k, v in d.items()}
+
 	@staticmethod
 	def get_param_from_dict(prefix, d):
 		arr = []
@@ -132,25 +308,24 @@ class Parameters(object):
 				arr.append((prefix + key, value))
 		return arr
 
-	def get_dict(self, args, external_config):
+	def get_config(self, args, external_config):
 		if len(args) != len(self.params):
 			print('Refresh webui first.')
 			raise Exception('Refresh webui first.')
 
+		config = Config()
 		if args[0]:
-			args_list = [(self.params[idx][0], v) for idx, v in enumerate(args)]
-			args_list.extend(self.ext_params)
-			ar = Parameters.get_dict_from_args(args_list, None)
-		else:
-			self.params.extend(self.ext_params)
-			ar = Parameters.get_dict_from_args(self.params, None)
+			for (path, attr, key, default), value in zip(arg_targets, args):
+				section = config
+				for name in path:
+					section = getattr(section, name)
+				setattr(section, attr, validate(key, default, value))
 
 		if external_config:
-			cfgarg = Parameters.get_param_from_dict('', external_config)
-			ar = Parameters.get_dict_from_args(cfgarg, ar)
-			ar['enabled'] = True
+			config.update(external_config)
+			config.enabled = True
 
-		return ar
+		return config
 
 	def get_default(self):
 		return [x[1] for x in self.params]
@@ -171,9 +346,7 @@ class Parameters(object):
 		if not os.path.isfile(json_file):
 			print(f'Not found configuration file {config_file}.json')
 			return '\n'.join(newprompt), {}
-		with open(json_file) as f:
-			config = json.load(f)
-		print('Loading config', json.dumps(config, indent=2))
+		config = load_json_cached(json_file)
 		return '\n'.join(newprompt), config
 
 	def load_preset(self, args):
@@ -189,9 +362,7 @@ class Parameters(object):
 		if not os.path.isfile(json_file):
 			print(f'Not found configuration file {name}.json')
 			return {}
-		with open(json_file) as f:
-			config = json.load(f)
-		print('Loading config', json.dumps(config, indent=2))
+		config = load_json_cached(json_file)
 		return config
 
 	def get_save_config_name(self, args):
@@ -4,14 +4,12 @@ import math
 import random
 
 from PIL import Image
-from PIL import ImageOps
 from PIL import ImageDraw
-from PIL import ImageEnhance
 
-from copy import copy, deepcopy
+from copy import copy
 from pathlib import Path
 
-from functools import partial
+from functools import partial, lru_cache
 
 from modules import shared
 from modules import devices
@@ -20,7 +18,7 @@ from modules.processing import process_images
 from modules.processing import StableDiffusionProcessingImg2Img
 from modules.processing import StableDiffusionProcessingTxt2Img
 
-from sd_bmab import dinosam, constants, util, detailing, controlnet
+from sd_bmab import dinosam, util, detailing, controlnet, instrument
 from sd_bmab.util import debug_print
 
 
@@ -45,50 +43,48 @@ def edge_flavor(pil, canny_th1: int, canny_th2: int, strength: float):
 	numpy_image = np.array(pil)
 	base = cv2.cvtColor(numpy_image, cv2.COLOR_RGB2BGR)
 	arcanny = cv2.Canny(base, canny_th1, canny_th2)
-	canny = Image.fromarray(arcanny)
-	canny = ImageOps.invert(canny)
 
-	newdata = [(0, 0, 0) if mdata == 0 else ndata for mdata, ndata in zip(canny.getdata(), pil.getdata())]
-	newbase = Image.new('RGB', pil.size)
-	newbase.putdata(newdata)
-	return Image.blend(pil, newbase, alpha=strength).convert("RGB")
+	edge = arcanny == 255
+	pixels = numpy_image[edge].astype(np.float32)
+	numpy_image[edge] = pixels + np.float32(strength) * (0 - pixels)
+	return Image.fromarray(numpy_image, mode='RGB')
 
 
 def check_process(args, p):
-	return args['edge_flavor_enabled'] or args['noise_alpha'] or args['face_detailing_enabled'] or args['hand_detailing_enabled'] or \
-		   (args['blend_enabled'] and args['input_image'] is not None and 0 <= args['blend_alpha'] <= 1) or \
-		   args['resize_by_person_enabled']
+	return args.edge_flavor_enabled or args.noise_alpha or args.face_detailing_enabled or args.hand_detailing_enabled or \
+		   (args.blend_enabled and args.input_image is not None and 0 <= args.blend_alpha <= 1) or \
+		   args.resize_by_person_enabled
 
 
 def check_hires_fix_process(args, p):
-	return args['edge_flavor_enabled'] or args['noise_alpha'] or args['hand_detailing_before_hiresfix_enabled'] or \
-		   args['hand_detailing_before_hiresfix_enabled'] or \
-		   (args['blend_enabled'] and args['input_image'] is not None and 0 <= args['blend_alpha'] <= 1) or \
-		   args['resize_by_person_enabled']
+	return args.edge_flavor_enabled or args.noise_alpha or args.hand_detailing_before_hiresfix_enabled or \
+		   args.hand_detailing_before_hiresfix_enabled or \
+		   (args.blend_enabled and args.input_image is not None and 0 <= args.blend_alpha <= 1) or \
+		   args.resize_by_person_enabled
 
 
 def process_all(s, p, args, bgimg, caller='before_img2img'):
-	if args['resize_by_person_enabled']:
+	if args.resize_by_person_enabled:
 		bgimg = process_resize_by_person(bgimg, s, p, args, caller=caller)
 
-	if args['noise_alpha'] != 0:
-		p.extra_generation_params['BMAB noise alpha'] = args['noise_alpha']
+	if args.noise_alpha != 0:
+		p.extra_generation_params['BMAB noise alpha'] = args.noise_alpha
 		img_noise = generate_noise(bgimg.size[0], bgimg.size[1])
-		bgimg = Image.blend(bgimg, img_noise, alpha=args['noise_alpha'])
+		bgimg = Image.blend(bgimg, img_noise, alpha=args.noise_alpha)
 
-	if args['edge_flavor_enabled']:
-		p.extra_generation_params['BMAB edge flavor low threadhold'] = args['edge_low_threadhold']
-		p.extra_generation_params['BMAB edge flavor high threadhold'] = args['edge_high_threadhold']
-		p.extra_generation_params['BMAB edge flavor strength'] = args['edge_strength']
-		bgimg = edge_flavor(bgimg, args['edge_low_threadhold'], args['edge_high_threadhold'], args['edge_strength'])
+	if args.edge_flavor_enabled:
+		p.extra_generation_params['BMAB edge flavor low threadhold'] = args.edge_low_threadhold
+		p.extra_generation_params['BMAB edge flavor high threadhold'] = args.edge_high_threadhold
+		p.extra_generation_params['BMAB edge flavor strength'] = args.edge_strength
+		bgimg = edge_flavor(bgimg, args.edge_low_threadhold, args.edge_high_threadhold, args.edge_strength)
 
-	if args['blend_enabled'] and args['input_image'] is not None and 0 <= args['blend_alpha'] <= 1:
-		p.extra_generation_params['BMAB blend alpha'] = args['blend_alpha']
-		blend = Image.fromarray(args['input_image'], mode='RGB')
+	if args.blend_enabled and args.input_image is not None and 0 <= args.blend_alpha <= 1:
+		p.extra_generation_params['BMAB blend alpha'] = args.blend_alpha
+		blend = Image.fromarray(args.input_image, mode='RGB')
 		img = Image.new(mode='RGB', size=bgimg.size)
 		img.paste(bgimg, (0, 0))
 		img.paste(blend)
-		bgimg = Image.blend(bgimg, img, alpha=args['blend_alpha'])
+		bgimg = Image.blend(bgimg, img, alpha=args.blend_alpha)
 
 	return bgimg
 
@@ -135,43 +131,105 @@ def calc_color_temperature(temp):
 	return red / white[0], green / white[1], blue / white[2]
 
 
-def after_process(bgimg, s, p, args):
+@lru_cache(maxsize=16)
+def color_temperature_lut(temperature):
+	lut = []
+	for factor in calc_color_temperature(6500 + temperature):
+		lut.extend(min(int(value * factor), 255) for value in range(256))
+	return tuple(lut)
 
-	if args['noise_alpha_final'] != 0:
-		p.extra_generation_params['BMAB noise alpha final'] = args['noise_alpha_final']
-		img_noise = generate_noise(bgimg.size[0], bgimg.size[1])
-		bgimg = Image.blend(bgimg, img_noise, alpha=args['noise_alpha_final'])
-
-	if args['contrast'] != 1:
-		p.extra_generation_params['BMAB contrast'] = args['contrast']
-		enhancer = ImageEnhance.Contrast(bgimg)
-		bgimg = enhancer.enhance(args['contrast'])
-
-	if args['brightness'] != 1:
-		p.extra_generation_params['BMAB brightness'] = args['brightness']
-		enhancer = ImageEnhance.Brightness(bgimg)
-		bgimg = enhancer.enhance(args['brightness'])
-
-	if args['sharpeness'] != 1:
-		p.extra_generation_params['BMAB sharpeness'] = args['sharpeness']
-		enhancer = ImageEnhance.Sharpness(bgimg)
-		bgimg = enhancer.enhance(args['sharpeness'])
-
-	if args['color_saturation'] != 1:
-		p.extra_generation_params['BMAB color'] = args['color_saturation']
-		enhancer = ImageEnhance.Color(bgimg)
-		bgimg = enhancer.enhance(args['color_saturation'])
-
-	if args['color_temperature'] != 0:
-		p.extra_generation_params['BMAB color temperature'] = args['color_temperature']
-		temp = calc_color_temperature(6500 + args['color_temperature'])
-		az = []
-		for d in bgimg.getdata():
-			az.append((int(d[0] * temp[0]), int(d[1] * temp[1]), int(d[2] * temp[2])))
-		bgimg = Image.new('RGB', bgimg.size)
-		bgimg.putdata(az)
 
-	return bgimg
+smooth_kernel = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+after_process_strip = 256
+
+
+def blend_array(arr1, arr2, alpha):
+	return np.asarray(Image.blend(Image.fromarray(arr1, mode='RGB'), Image.fromarray(arr2, mode='RGB'), alpha))
+
+
+def luminance_array(arr):
+	return np.asarray(Image.fromarray(arr, mode='RGB').convert('L'))
+
+
+def after_process(bgimg, s, p, args):
+	noise_alpha = args.noise_alpha_final
+	contrast = args.contrast
+	brightness = args.brightness
+	sharpeness = args.sharpeness
+	color = args.color_saturation
+	temperature = args.color_temperature
+
+	if noise_alpha == 0 and contrast == 1 and brightness == 1 and sharpeness == 1 and color == 1 and temperature == 0:
+		return bgimg
+
+	arr = np.array(bgimg.convert('RGB'))
+	height = arr.shape[0]
+
+	if noise_alpha != 0:
+		p.extra_generation_params['BMAB noise alpha final'] = noise_alpha
+		img_noise = np.asarray(generate_noise(bgimg.size[0], bgimg.size[1]))
+		for y in range(0, height, after_process_strip):
+			strip = slice(y, y + after_process_strip)
+			arr[strip] = blend_array(arr[strip], img_noise[strip], noise_alpha)
+		del img_noise
+
+	lut = None
+	if contrast != 1:
+		p.extra_generation_params['BMAB contrast'] = contrast
+		total = 0
+		for y in range(0, height, after_process_strip):
+			total += int(luminance_array(arr[y:y + after_process_strip]).sum(dtype=np.uint64))
+		mean = int(total / (arr.shape[0] * arr.shape[1]) + 0.5)
+		lut = np.clip(mean + np.float32(contrast) * (np.arange(256, dtype=np.float32) - mean), 0, 255).astype(np.uint8)
+
+	if brightness != 1:
+		p.extra_generation_params['BMAB brightness'] = brightness
+		base = np.arange(256, dtype=np.float32) if lut is None else lut.astype(np.float32)
+		lut = np.clip(np.float32(brightness) * base, 0, 255).astype(np.uint8)
+
+	if sharpeness != 1:
+		p.extra_generation_params['BMAB sharpeness'] = sharpeness
+
+	if color != 1:
+		p.extra_generation_params['BMAB color'] = color
+
+	temperature_lut = None
+	if temperature != 0:
+		p.extra_generation_params['BMAB color temperature'] = temperature
+		temperature_lut = np.array(color_temperature_lut(temperature), dtype=np.uint8).reshape(3, 256).T.reshape(256, 1, 3).copy()
+
+	out = np.empty_like(arr)
+	for y in range(0, height, after_process_strip):
+		y1 = min(y + after_process_strip, height)
+		# one row of context above and below for the 3x3 sharpness kernel.
+		top = max(y - 1, 0)
+		bottom = min(y1 + 1, height)
+		strip = arr[top:bottom]
+
+		if lut is not None:
+			strip = cv2.LUT(strip, lut)
+
+		if sharpeness != 1:
+			smoothed = cv2.filter2D(strip, -1, smooth_kernel, borderType=cv2.BORDER_REPLICATE)
+			smoothed[:, [0, -1]] = strip[:, [0, -1]]
+			if top == 0:
+				smoothed[0] = strip[0]
+			if bottom == height:
+				smoothed[-1] = strip[-1]
+			strip = blend_array(smoothed, strip, sharpeness)
+
+		strip = strip[y - top:y1 - top]
+
+		if color != 1:
+			gray = cv2.cvtColor(luminance_array(strip), cv2.COLOR_GRAY2RGB)
+			strip = blend_array(gray, strip, color)
+
+		if temperature_lut is not None:
+			strip = cv2.LUT(strip, temperature_lut)
+
+		out[y:y1] = strip
+
+	return Image.fromarray(out, mode='RGB')
 
 
 def process_prompt(prompt):
@@ -193,10 +251,10 @@ def process_resize_by_person(img, s, p, arg, caller='before_img2img'):
 	if shared.state.skipped or shared.state.interrupted:
 		return img
 
-	enabled = arg.get('resize_by_person_enabled', False)
-	resize_by_person_opt = arg.get('module_config', {}).get('resize_by_person_opt', {})
-	mode = resize_by_person_opt.get('mode', constants.resize_mode_default)
-	value = resize_by_person_opt.get('scale', 0)
+	enabled = arg.resize_by_person_enabled
+	resize_by_person_opt = arg.module_config.resize_by_person_opt
+	mode = resize_by_person_opt.mode
+	value = resize_by_person_opt.scale
 
 	if not enabled:
 		return img
@@ -217,30 +275,17 @@ def process_resize_by_person(img, s, p, arg, caller='before_img2img'):
 
 @detailing.timecalc
 def process_resize_by_person_intermedate(img, s, p, a):
-	resize_by_person_opt = a.get('module_config', {}).get('resize_by_person_opt', {})
-	value = resize_by_person_opt.get('scale', 0)
+	resize_by_person_opt = a.module_config.resize_by_person_opt
+	value = resize_by_person_opt.scale
 
 	p.extra_generation_params['BMAB process_resize_by_person'] = value
 
-	debug_print('prepare dino')
-	dinosam.dino_init()
-	boxes, logits, phrases = dinosam.dino_predict(img, 'person')
-
 	org_size = img.size
 	debug_print('size', org_size)
 
-	largest = (0, None)
-	for box in boxes:
-		x1, y1, x2, y2 = box
-		size = (x2 - x1) * (y2 - y1)
-		if size > largest[0]:
-			largest = (size, box)
-
-	if largest[0] == 0:
+	ratio = dinosam.person_ratio_estimator.estimate(img)
+	if ratio == 0:
 		return img
-
-	x1, y1, x2, y2 = largest[1]
-	ratio = (y2 - y1) / img.height
 	debug_print('ratio', ratio)
 	debug_print('org_size', org_size)
 
@@ -258,21 +303,22 @@ def process_resize_by_person_intermedate(img, s, p, a):
 
 @detailing.timecalc
 def process_resize_by_person_using_controlnet(img, s, p, a):
-	resize_by_person_opt = a.get('module_config', {}).get('resize_by_person_opt', {})
-	value = resize_by_person_opt.get('scale', 0)
-	denoising_strength = resize_by_person_opt.get('denoising_strength', 0.4)
-	dilation = resize_by_person_opt.get('dilation', 0.4)
+	resize_by_person_opt = a.module_config.resize_by_person_opt
+	value = resize_by_person_opt.scale
+	denoising_strength = resize_by_person_opt.denoising_strength
+	dilation = resize_by_person_opt.dilation
 
 	opt = dict(denoising_strength=denoising_strength)
 	i2i_param = build_img2img(p, img, opt)
 
 	img2img = StableDiffusionProcessingImg2Img(**i2i_param)
-	img2img.cached_c = [None, None]
-	img2img.cached_uc = [None, None]
+	img2img.cached_c, img2img.cached_uc = get_conditioning_cache(p, img2img)
 	img2img.scripts, img2img.script_args = apply_extensions(p, cn_enabled=True)
 
 	if controlnet.resize_by_person_using_controlnet(s, img2img, a, 0, value, dilation):
-		processed = process_images(img2img)
+		instrument.count('img2img')
+		with instrument.timed('inference'):
+			processed = process_images(img2img)
 		img = processed.images[0]
 		img2img.close()
 		devices.torch_gc()
@@ -281,30 +327,17 @@ def process_resize_by_person_using_controlnet(img, s, p, a):
 
 @detailing.timecalc
 def process_resize_by_person_using_inpaint(img, s, p, a):
-	resize_by_person_opt = a.get('module_config', {}).get('resize_by_person_opt', {})
-	value = resize_by_person_opt.get('scale', 0)
-	denoising_strength = resize_by_person_opt.get('denoising_strength', 0.4)
-	dilation = resize_by_person_opt.get('dilation', 0.4)
-
-	debug_print('prepare dino')
-	dinosam.dino_init()
-	boxes, logits, phrases = dinosam.dino_predict(img, 'person')
+	resize_by_person_opt = a.module_config.resize_by_person_opt
+	value = resize_by_person_opt.scale
+	denoising_strength = resize_by_person_opt.denoising_strength
+	dilation = resize_by_person_opt.dilation
 
 	org_size = img.size
 	debug_print('size', org_size)
 
-	largest = (0, None)
-	for box in boxes:
-		x1, y1, x2, y2 = box
-		size = (x2 - x1) * (y2 - y1)
-		if size > largest[0]:
-			largest = (size, box)
-
-	if largest[0] == 0:
+	ratio = dinosam.person_ratio_estimator.estimate(img)
+	if ratio == 0:
 		return img
-
-	x1, y1, x2, y2 = largest[1]
-	ratio = (y2 - y1) / img.height
 	debug_print('ratio', ratio)
 	debug_print('org_size', org_size)
 	if ratio <= value:
@@ -340,11 +373,12 @@ def process_resize_by_person_using_inpaint(img, s, p, a):
 	i2i_param = build_img2img(p, input_image, opt)
 
 	img2img = StableDiffusionProcessingImg2Img(**i2i_param)
-	img2img.cached_c = [None, None]
-	img2img.cached_uc = [None, None]
+	img2img.cached_c, img2img.cached_uc = get_conditioning_cache(p, img2img)
 	img2img.scripts, img2img.script_args = apply_extensions(p, cn_enabled=False)
 
-	processed = process_images(img2img)
+	instrument.count('img2img')
+	with instrument.timed('inference'):
+		processed = process_images(img2img)
 	img = processed.images[0]
 
 	img2img.close()
@@ -361,31 +395,50 @@ def sam(prompt, input_image):
 
 def apply_extensions(p, cn_enabled=False):
 	script_runner = copy(p.scripts)
-	script_args = deepcopy(p.script_args)
-	active_script = ['dynamic_thresholding']
+	script_args = p.script_args
 
-	if cn_enabled:
-		active_script.append('controlnet')
+	if cn_enabled and script_args:
+		script_args = list(script_args)
 		for idx, obj in enumerate(script_args):
 			if 'controlnet' in obj.__class__.__name__.lower():
+				obj = copy(obj)
 				if hasattr(obj, 'enabled'):
 					obj.enabled = False
 				if hasattr(obj, 'input_mode'):
 					obj.input_mode = getattr(obj.input_mode, 'SIMPLE', 'simple')
+				script_args[idx] = obj
 			elif isinstance(obj, dict) and 'module' in obj:
+				obj = dict(obj)
 				obj['enabled'] = False
+				script_args[idx] = obj
+		script_args = type(p.script_args)(script_args)
 
-	filtered_alwayson = []
-	for script_object in script_runner.alwayson_scripts:
-		filepath = script_object.filename
-		filename = Path(filepath).stem
-		if filename in active_script:
-			filtered_alwayson.append(script_object)
-
-	script_runner.alwayson_scripts = filtered_alwayson
+	script_runner.alwayson_scripts = get_alwayson_scripts(p, cn_enabled)
 	return script_runner, script_args
 
 
+def get_alwayson_scripts(p, cn_enabled):
+	cache = getattr(p, 'bmab_alwayson_scripts', None)
+	if cache is None or cache[0] is not p.scripts:
+		cache = (p.scripts, {})
+		p.bmab_alwayson_scripts = cache
+
+	if cn_enabled not in cache[1]:
+		active_script = ['dynamic_thresholding']
+		if cn_enabled:
+			active_script.append('controlnet')
+
+		filtered_alwayson = []
+		for script_object in p.scripts.alwayson_scripts:
+			filepath = script_object.filename
+			filename = Path(filepath).stem
+			if filename in active_script:
+				filtered_alwayson.append(script_object)
+		cache[1][cn_enabled] = filtered_alwayson
+
+	return list(cache[1][cn_enabled])
+
+
 def build_img2img(p, img, options):
 
 	img = img.convert('RGB')
@@ -439,24 +492,54 @@ def build_img2img(p, img, options):
 	return i2i_param
 
 
+def get_conditioning_cache(p, img2img):
+	caches = getattr(p, 'bmab_conditioning_cache', None)
+	if caches is None:
+		caches = {}
+		p.bmab_conditioning_cache = caches
+
+	prompt = img2img.prompt
+	negative_prompt = img2img.negative_prompt
+	key = (
+		tuple(prompt) if isinstance(prompt, list) else prompt,
+		tuple(negative_prompt) if isinstance(negative_prompt, list) else negative_prompt,
+		img2img.steps,
+		getattr(img2img.sd_model, 'sd_model_hash', None),
+	)
+	if key not in caches:
+		caches[key] = ([None, None], [None, None])
+	return caches[key]
+
+
+def get_detailing_batch_size():
+	return max(shared.opts.data.get('bmab_detailing_batch_size', 1), 1)
+
+
 def process_img2img(p, img, options=None):
+	return process_img2img_batch(p, [img], options=options)[0]
+
+
+def process_img2img_batch(p, imgs, options=None):
 	if shared.state.skipped or shared.state.interrupted:
-		return img
+		return imgs
 
-	i2i_param = build_img2img(p, img, options)
+	i2i_param = build_img2img(p, imgs[0], options)
+	i2i_param['init_images'] = [img.convert('RGB') for img in imgs]
+	i2i_param['batch_size'] = len(imgs)
 
 	img2img = StableDiffusionProcessingImg2Img(**i2i_param)
-	img2img.cached_c = [None, None]
-	img2img.cached_uc = [None, None]
+	img2img.cached_c, img2img.cached_uc = get_conditioning_cache(p, img2img)
 	img2img.scripts, img2img.script_args = apply_extensions(p)
 
-	processed = process_images(img2img)
-	img = processed.images[0]
+	instrument.count('img2img')
+	with instrument.timed('inference'):
+		processed = process_images(img2img)
+	results = processed.images[:len(imgs)]
 
 	img2img.close()
 
 	devices.torch_gc()
-	return img
+	return results
 
 
 def process_txt2img(s, p, a, options: dict):
@@ -495,7 +578,8 @@ def process_txt2img(s, p, a, options: dict):
 	txt2img.scripts = None
 	txt2img.script_args = None
 
-	processed = process_images(txt2img)
+	with instrument.timed('inference'):
+		processed = process_images(txt2img)
 	debug_print('seeds', txt2img.seed)
 	debug_print('all seeds', txt2img.all_seeds)
 	img = processed.images[0]
@@ -514,45 +598,59 @@ def masked_image(img, xyxy):
 
 
 def process_dino_detect(p, s, a):
-	if a['dino_detect_enabled']:
+	if a.dino_detect_enabled:
 		if p.image_mask is not None:
 			s.extra_image.append(p.init_images[0])
 			s.extra_image.append(p.image_mask)
-			p.image_mask = sam(a['dino_prompt'], p.init_images[0])
+			p.image_mask = sam(a.dino_prompt, p.init_images[0])
 			s.extra_image.append(p.image_mask)
 			devices.torch_gc()
-		if p.image_mask is None and a['input_image'] is not None:
-			mask = sam(a['dino_prompt'], p.init_images[0])
-			inputimg = a['input_image']
-			newpil = Image.new('RGB', p.init_images[0].size)
-			newdata = [bdata if mdata == 0 else ndata for mdata, ndata, bdata in zip(mask.getdata(), p.init_images[0].getdata(), inputimg.getdata())]
-			newpil.putdata(newdata)
+		if p.image_mask is None and a.input_image is not None:
+			mask = sam(a.dino_prompt, p.init_images[0])
+			inputimg = a.input_image
+			if not isinstance(inputimg, Image.Image):
+				inputimg = Image.fromarray(inputimg)
+			inputimg = inputimg.convert('RGB')
+			if inputimg.size != p.init_images[0].size:
+				inputimg = inputimg.resize(p.init_images[0].size, resample=LANCZOS)
+			newpil = Image.composite(p.init_images[0].convert('RGB'), inputimg, mask.point(lambda v: 255 if v else 0))
 			p.init_images[0] = newpil
 			s.extra_image.append(newpil)
 
 
+def get_init_image(p, idx):
+	if p.image_mask is not None or p.resize_mode == 3 or idx >= len(p.init_images):
+		return None
+	image = images.flatten(p.init_images[idx], shared.opts.img2img_background_color)
+	return images.resize_image(p.resize_mode, image, p.width, p.height)
+
+
 def process_img2img_process_all(s, p, a):
 	if isinstance(p, StableDiffusionProcessingImg2Img):
+		img = None
 		if p.resize_mode == 2 and len(p.init_images) == 1:
 			im = p.init_images[0]
 			p.extra_generation_params['BMAB resize image'] = '%s %s' % (p.width, p.height)
 			img = util.resize_image(p.resize_mode, im, p.width, p.height)
 			s.extra_image.append(img)
-			for idx in range(0, len(p.init_latent)):
-				p.init_latent[idx] = util.image_to_latent(p, img)
-				devices.torch_gc()
+			p.init_latent[:] = util.image_to_latent(p, img)
+			devices.torch_gc()
 
 		if check_process(a, p):
 			if len(p.init_images) == 1:
-				img = util.latent_to_image(p.init_latent, 0)
+				if img is None:
+					img = get_init_image(p, 0)
+				if img is None:
+					img = util.latent_to_image(p.init_latent, 0)
 				img = process_all(s, p, a, img)
 				s.extra_image.append(img)
-				for idx in range(0, len(p.init_latent)):
-					p.init_latent[idx] = util.image_to_latent(p, img)
-					devices.torch_gc()
+				p.init_latent[:] = util.image_to_latent(p, img)
+				devices.torch_gc()
 			else:
 				for idx in range(0, len(p.init_latent)):
-					img = util.latent_to_image(p.init_latent, idx)
+					img = get_init_image(p, idx)
+					if img is None:
+						img = util.latent_to_image(p.init_latent, idx)
 					img = process_all(s, p, a, img)
 					s.extra_image.append(img)
 					p.init_latent[idx] = util.image_to_latent(p, img)
@@ -568,10 +666,10 @@ def override_sample(s, p, a):
 		images.resize_image = p.resize_hook
 		pidx = _p.iteration * _p.batch_size
 		_p.__idx += 1
-		arg['current_prompt'] = _p.all_prompts[pidx]
-		if arg['face_detailing_before_hiresfix_enabled']:
+		arg.current_prompt = _p.all_prompts[pidx]
+		if arg.face_detailing_before_hiresfix_enabled:
 			img = detailing.process_face_detailing_inner(img, _s, _p, arg)
-		if arg['hand_detailing_before_hiresfix_enabled']:
+		if arg.hand_detailing_before_hiresfix_enabled:
 			img = detailing.process_hand_detailing(img, _s, _p, arg)
 		# s.extra_image.append(img)
 		im = _p.resize_hook(resize_mode, img, width, height, upscaler_name)
@@ -595,21 +693,21 @@ def override_sample(s, p, a):
 
 
 def process_upscale_before_detailing(image, s, p, a):
-	if not a['upscale_enabled'] or not a['detailing_after_upscale']:
+	if not a.upscale_enabled or not a.detailing_after_upscale:
 		return image
 	return process_upscale_inner(image, s, p, a)
 
 
 def process_upscale_after_detailing(image, s, p, a):
-	if not a['upscale_enabled'] or a['detailing_after_upscale']:
+	if not a.upscale_enabled or a.detailing_after_upscale:
 		return image
 	return process_upscale_inner(image, s, p, a)
 
 
 @detailing.timecalc
 def process_upscale_inner(image, s, p, args):
-	ratio = args['upscale_ratio']
-	upscaler = args['upscaler_name']
+	ratio = args.upscale_ratio
+	upscaler = args.upscaler_name
 	debug_print(f'Upscale ratio {ratio} Upscaler {upscaler}')
 	p.extra_generation_params['BMAB_upscale_option'] = f'Upscale ratio {ratio} Upscaler {upscaler}'
 
@@ -618,10 +716,16 @@ def process_upscale_inner(image, s, p, args):
 		return image
 	image = image.convert('RGB')
 	p.extra_generation_params['BMAB process upscale'] = ratio
-	args['max_area'] = image.width * image.height
-	args['upscale_limit'] = True
+	args.max_area = image.width * image.height
+	args.upscale_limit = True
 
 	w = image.width
 	h = image.height
-	img = images.resize_image(0, image, int(w * ratio), int(h * ratio), upscaler)
+	tile_size = shared.opts.data.get('bmab_upscale_tile_size', 0)
+	if tile_size > 0:
+		overlap = shared.opts.data.get('bmab_upscale_tile_overlap', 64)
+		debug_print(f'Tiled upscale tile {tile_size} overlap {overlap}')
+		img = util.resize_image_tiled(image, int(w * ratio), int(h * ratio), upscaler, tile_size, overlap)
+	else:
+		img = images.resize_image(0, image, int(w * ratio), int(h * ratio), upscaler)
 	return img.convert('RGB')
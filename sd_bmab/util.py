@@ -1,18 +1,28 @@
 import os
 import cv2
+import math
+import atexit
+import shutil
+import weakref
+import tempfile
+import hashlib
 import torch
 import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 import modules
 from modules import shared
 from modules import devices
 from modules import images
+from modules import masking
 from modules.sd_samplers import sample_to_image
 from modules.paths import models_path
 
 from ultralytics import YOLO
 
+from sd_bmab import cache, instrument
+
 
 def debug_print(*args):
 	if shared.opts.bmab_debug_print:
@@ -75,6 +85,73 @@ def resize_image(resize_mode, im, width, height, upscaler_name=None):
 	return images.resize_image(resize_mode, im, width, height, upscaler_name)
 
 
+cpu_upscalers = (None, 'None', 'Lanczos', 'Nearest')
+
+
+def tile_positions(length, tile_size, overlap):
+	if length <= tile_size:
+		return [0]
+	positions = list(range(0, length - tile_size, tile_size - overlap))
+	positions.append(length - tile_size)
+	return positions
+
+
+def tile_blend_mask(width, height, left, top):
+	wx = np.ones(width, dtype=np.float32)
+	wy = np.ones(height, dtype=np.float32)
+	if left > 0:
+		wx[:left] = np.linspace(0, 1, left, endpoint=False, dtype=np.float32)
+	if top > 0:
+		wy[:top] = np.linspace(0, 1, top, endpoint=False, dtype=np.float32)
+	return Image.fromarray((np.outer(wy, wx) * 255).astype(np.uint8))
+
+
+def resize_image_tiled(im, width, height, upscaler_name, tile_size, overlap):
+	if im.width <= tile_size and im.height <= tile_size:
+		return images.resize_image(0, im, width, height, upscaler_name)
+
+	overlap = min(overlap, tile_size // 2)
+	if upscaler_name in cpu_upscalers:
+		canvas_width, canvas_height = width, height
+	else:
+		# model upscalers work on a whole-number scale so every tile stays on the source pixel grid
+		scale = max(1, math.ceil(max(width / im.width, height / im.height)))
+		canvas_width, canvas_height = im.width * scale, im.height * scale
+	sx = canvas_width / im.width
+	sy = canvas_height / im.height
+	resample = Image.NEAREST if upscaler_name == 'Nearest' else Image.LANCZOS
+
+	def to_canvas(box):
+		x1, y1, x2, y2 = box
+		return round(x1 * sx), round(y1 * sy), round(x2 * sx), round(y2 * sy)
+
+	def upscale_tile(box):
+		x1, y1, x2, y2 = to_canvas(box)
+		if upscaler_name in cpu_upscalers:
+			# resample from the exact source box, so the tile matches the same region of a full resize
+			return im.resize((x2 - x1, y2 - y1), resample=resample, box=(x1 / sx, y1 / sy, x2 / sx, y2 / sy)).convert('RGB')
+		return images.resize_image(0, im.crop(box), x2 - x1, y2 - y1, upscaler_name).convert('RGB')
+
+	result = Image.new('RGB', (canvas_width, canvas_height))
+	xs = tile_positions(im.width, tile_size, overlap)
+	ys = tile_positions(im.height, tile_size, overlap)
+	workers = min(os.cpu_count() or 1, len(xs)) if upscaler_name in cpu_upscalers else 1
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		for y in ys:
+			row = [(x, y, min(x + tile_size, im.width), min(y + tile_size, im.height)) for x in xs]
+			for box, tile in zip(row, executor.map(upscale_tile, row)):
+				x1, y1 = to_canvas(box)[:2]
+				left = round(overlap * sx) if box[0] > 0 else 0
+				top = round(overlap * sy) if box[1] > 0 else 0
+				mask = tile_blend_mask(tile.width, tile.height, left, top)
+				result.paste(tile, (x1, y1), mask=mask)
+			devices.torch_gc()
+
+	if result.size != (width, height):
+		result = result.resize((width, height), resample=Image.LANCZOS)
+	return result
+
+
 def box_dilation(box, dil):
 	x1, y1, x2, y2 = tuple(int(x) for x in box)
 	dx = int((x2 - x1) * dil)
@@ -135,6 +212,12 @@ def fix_sqare_box(box):
 	return x1, y1, x2, y2
 
 
+def get_crop_region(box, padding, width, height, size):
+	x1, y1, x2, y2 = tuple(int(x) for x in box)
+	region = (max(x1 - padding, 0), max(y1 - padding, 0), min(x2 + padding, size[0]), min(y2 + padding, size[1]))
+	return masking.expand_crop_region(region, width, height, size[0], size[1])
+
+
 def change_vae(name='auto'):
 	modules.sd_vae.reload_vae_weights(shared.sd_model, vae_file=modules.sd_vae.vae_dict[name])
 
@@ -153,40 +236,180 @@ def get_seeds(s, p, a):
 	return p.all_seeds[s.index], p.all_subseeds[s.index]
 
 
+yolo_models = {}
+
+
+def ultralytics_init(model_path, device=''):
+	key = (model_path, device)
+	model = yolo_models.get(key)
+	if model is None:
+		load = torch.load
+		torch.load = modules.safe.unsafe_torch_load
+		try:
+			with instrument.timed('load'):
+				model = YOLO(model_path)
+		finally:
+			torch.load = load
+		yolo_models[key] = model
+	return model
+
+
 def ultralytics_predict(image, confidence):
 	bmab_model_path = os.path.join(models_path, "bmab")
 	yolo = f'{bmab_model_path}/face_yolov8n.pt'
+
+	disk_key = None
+	if cache.is_enabled():
+		disk_key = cache.make_key('yolo', image_hash(image), cache.model_hash(yolo), confidence)
+		data = cache.detection_cache.get(disk_key)
+		if data is not None:
+			return data['boxes'].tolist()
+
 	boxes = []
-	load = torch.load
-	torch.load = modules.safe.unsafe_torch_load
 	try:
-		model = YOLO(yolo)
-		pred = model(image, conf=confidence, device='')
+		model = ultralytics_init(yolo)
+		with instrument.timed('inference'):
+			pred = model(image, conf=confidence, device='')
 		boxes = pred[0].boxes.xyxy.cpu().numpy()
+		if disk_key is not None:
+			cache.detection_cache.put(disk_key, boxes=boxes)
 		boxes = boxes.tolist()
 	except:
 		pass
-	torch.load = load
 	return boxes
 
 
+def ultralytics_release():
+	yolo_models.clear()
+
+
+def image_hash(img):
+	h = hashlib.sha1()
+	h.update(f'{img.mode}{img.size}'.encode())
+	h.update(img.tobytes())
+	return h.hexdigest()
+
+
 def dict_to_str(d):
 	return ','.join([f'{k}={v}' for k, v in d.items()])
 
 
+class MaskROI(object):
+
+	def __init__(self, box, mask, size) -> None:
+		super().__init__()
+		self.box = box
+		self.mask = mask
+		self.size = size
+
+	@staticmethod
+	def from_image(mask):
+		mask = mask.convert('L')
+		box = mask.getbbox()
+		if box is None:
+			return MaskROI(None, None, mask.size)
+		return MaskROI(box, mask.crop(box), mask.size)
+
+	def expand(self, padding):
+		x1, y1, x2, y2 = self.box
+		box = (max(x1 - padding, 0), max(y1 - padding, 0), min(x2 + padding, self.size[0]), min(y2 + padding, self.size[1]))
+		canvas = Image.new('L', (box[2] - box[0], box[3] - box[1]), 0)
+		canvas.paste(self.mask, (x1 - box[0], y1 - box[1]))
+		return box, canvas
+
+	def morphology(self, op, value):
+		if self.box is None:
+			return self
+		box, canvas = self.expand(value)
+		kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (value, value))
+		arr = op(np.array(canvas), kernel, iterations=1)
+		return MaskROI(box, Image.fromarray(arr), self.size)
+
+	def dilate(self, dilation):
+		if dilation < 4:
+			return self
+		return self.morphology(cv2.dilate, dilation)
+
+	def erode(self, erosion):
+		if erosion < 4:
+			return self
+		return self.morphology(cv2.erode, erosion)
+
+	def filter(self, image_filter, padding):
+		if self.box is None:
+			return self
+		box, canvas = self.expand(padding)
+		return MaskROI(box, canvas.filter(image_filter), self.size)
+
+	def crop(self, box):
+		x1, y1, x2, y2 = tuple(int(round(x)) for x in box)
+		cropped = Image.new('L', (x2 - x1, y2 - y1), 0)
+		if self.box is not None:
+			cropped.paste(self.mask, (self.box[0] - x1, self.box[1] - y1))
+		return cropped
+
+	def to_image(self):
+		return self.crop((0, 0, self.size[0], self.size[1]))
+
+
 def dilate_mask(mask, dilation):
 	if dilation < 4:
 		return mask
-	arr = np.array(mask)
-	kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (dilation, dilation))
-	arr = cv2.dilate(arr, kernel, iterations=1)
-	return Image.fromarray(arr)
+	return MaskROI.from_image(mask).dilate(dilation).to_image()
 
 
 def erode_mask(mask, erosion):
 	if erosion < 4:
 		return mask
-	arr = np.array(mask)
-	kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (erosion, erosion))
-	arr = cv2.erode(arr, kernel, iterations=1)
-	return Image.fromarray(arr)
+	return MaskROI.from_image(mask).erode(erosion).to_image()
+
+
+class ExtraImages(object):
+	stores = weakref.WeakSet()
+
+	def __init__(self) -> None:
+		super().__init__()
+		self.items = []
+		self.memory = 0
+		self.directory = None
+		ExtraImages.stores.add(self)
+
+	@staticmethod
+	def clear_all():
+		for store in list(ExtraImages.stores):
+			store.clear()
+
+	@staticmethod
+	def is_recording():
+		return shared.opts.data.get('bmab_show_extends', False)
+
+	@staticmethod
+	def get_budget():
+		return shared.opts.data.get('bmab_extra_image_budget', 256) * 1024 * 1024
+
+	def append(self, image):
+		if image is None or not self.is_recording():
+			return
+		nbytes = image.width * image.height * len(image.getbands())
+		if self.memory + nbytes <= self.get_budget():
+			self.memory += nbytes
+			self.items.append(image)
+			return
+		if self.directory is None:
+			self.directory = tempfile.mkdtemp(prefix='bmab-extra-')
+		path = os.path.join(self.directory, f'{len(self.items):04}.png')
+		image.save(path, compress_level=1)
+		self.items.append(path)
+
+	def images(self):
+		return [Image.open(x) if isinstance(x, str) else x for x in self.items]
+
+	def clear(self):
+		self.items = []
+		self.memory = 0
+		if self.directory is not None:
+			shutil.rmtree(self.directory, ignore_errors=True)
+			self.directory = None
+
+
+atexit.register(ExtraImages.clear_all)
@@ -0,0 +1,128 @@
+import os
+import atexit
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from modules import shared
+from modules import images
+
+
+def get_filename(image, path, basename, seed, prompt, extension, p, suffix):
+	# same naming rules as images.save_image, evaluated on the caller thread.
+	# returns the directory and the name without extension for save_image(forced_filename=...)
+	opts = shared.opts
+	namegen = images.FilenameGenerator(p, seed, prompt, image)
+	if (image.height > 65535 or image.width > 65535) and extension.lower() in ('jpg', 'jpeg') or (image.height > 16383 or image.width > 16383) and extension.lower() == 'webp':
+		extension = 'png'
+	if opts.save_to_dirs:
+		dirname = namegen.apply(opts.directories_filename_pattern or '[prompt_words]').lstrip(' ').rstrip('\\ /')
+		path = os.path.join(path, dirname)
+	os.makedirs(path, exist_ok=True)
+
+	if seed is None:
+		file_decoration = ''
+	elif opts.save_to_dirs:
+		file_decoration = opts.samples_filename_pattern or '[seed]'
+	else:
+		file_decoration = opts.samples_filename_pattern or '[seed]-[prompt_spaces]'
+	file_decoration = namegen.apply(file_decoration) + suffix
+
+	add_number = opts.save_images_add_number or file_decoration == ''
+	if file_decoration != '' and add_number:
+		file_decoration = f'-{file_decoration}'
+	if not add_number:
+		return path, file_decoration, extension
+
+	basecount = images.get_next_sequence_number(path, basename)
+	name = None
+	for i in range(500):
+		fn = f'{basecount + i:05}' if basename == '' else f'{basename}-{basecount + i:04}'
+		name = f'{fn}{file_decoration}'
+		if not os.path.exists(os.path.join(path, f'{name}.{extension}')):
+			break
+	return path, name, extension
+
+
+class ImageWriter(object):
+
+	def __init__(self, max_pending=4) -> None:
+		super().__init__()
+		self.executor = None
+		self.lock = threading.Lock()
+		self.slots = threading.BoundedSemaphore(max_pending)
+		self.pending = []
+		self.reserved = set()
+
+	def get_executor(self):
+		with self.lock:
+			if self.executor is None:
+				self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bmab-writer')
+			return self.executor
+
+	def release(self, reserved):
+		# drop the placeholder unless save_image wrote the image over it
+		with self.lock:
+			self.reserved.discard(reserved)
+		if os.path.exists(reserved) and os.path.getsize(reserved) == 0:
+			os.remove(reserved)
+
+	def write(self, image, path, basename, seed, prompt, extension, p, name, reserved):
+		try:
+			fullfn, _ = images.save_image(image, path, basename, seed, prompt, extension, p=p, forced_filename=name, save_to_dirs=False)
+			return fullfn
+		except Exception:
+			print('BMAB failed to save image', reserved)
+			traceback.print_exc()
+			return None
+		finally:
+			self.release(reserved)
+			self.slots.release()
+
+	def save(self, image, path, basename, seed=None, prompt=None, extension='png', p=None, suffix=''):
+		self.collect(wait=False)
+
+		image = image.copy()
+		path, name, extension = get_filename(image, path, basename, seed, prompt, extension, p, suffix)
+
+		# reserve the name so the next save, ours or webui's, gets the next sequence number
+		reserved = os.path.join(path, f'{name}.{extension}')
+		open(reserved, 'ab').close()
+		with self.lock:
+			self.reserved.add(reserved)
+
+		self.slots.acquire()
+		try:
+			future = self.get_executor().submit(self.write, image, path, basename, seed, prompt, extension, p, name, reserved)
+		except Exception:
+			self.release(reserved)
+			self.slots.release()
+			raise
+		with self.lock:
+			self.pending.append(future)
+
+	def collect(self, wait=True):
+		with self.lock:
+			if wait:
+				done, self.pending = self.pending, []
+			else:
+				done = [f for f in self.pending if f.done()]
+				self.pending = [f for f in self.pending if not f.done()]
+		for future in done:
+			future.result()
+
+	def flush(self):
+		self.collect(wait=True)
+
+	def shutdown(self):
+		self.flush()
+		with self.lock:
+			executor, self.executor = self.executor, None
+		if executor is not None:
+			executor.shutdown(wait=True)
+		for reserved in list(self.reserved):
+			self.release(reserved)
+
+
+image_writer = ImageWriter()
+atexit.register(image_writer.shutdown)
@@ -0,0 +1,56 @@
+"""
+process.process_dino_detect must composite exactly like the original per-pixel loop.
+
+    python -m pytest -q tests
+"""
+import types
+
+import numpy as np
+from PIL import Image
+
+from sd_bmab import process
+
+
+def composite_old(mask, init_image, input_image):
+	newpil = Image.new('RGB', init_image.size)
+	newdata = [bdata if mdata == 0 else ndata for mdata, ndata, bdata in zip(mask.getdata(), init_image.getdata(), input_image.getdata())]
+	newpil.putdata(newdata)
+	return newpil
+
+
+def make_inputs(size, seed):
+	rnd = np.random.RandomState(seed)
+	init_image = Image.fromarray(rnd.randint(0, 255, (size[1], size[0], 3), dtype=np.uint8))
+	input_image = Image.fromarray(rnd.randint(0, 255, (size[1], size[0], 3), dtype=np.uint8))
+	mask = Image.fromarray(rnd.choice(np.array([0, 0, 1, 128, 255], dtype=np.uint8), (size[1], size[0])), mode='L')
+	return init_image, input_image, mask
+
+
+def run_new(init_image, input_image, mask):
+	sam = process.sam
+	process.sam = lambda prompt, image: mask
+	try:
+		p = types.SimpleNamespace(image_mask=None, init_images=[init_image])
+		s = types.SimpleNamespace(extra_image=[])
+		a = types.SimpleNamespace(dino_detect_enabled=True, dino_prompt='person', input_image=input_image)
+		process.process_dino_detect(p, s, a)
+	finally:
+		process.sam = sam
+	return p.init_images[0]
+
+
+def test_composite_pil_input():
+	for size, seed in (((64, 48), 0), ((127, 131), 1), ((256, 256), 2)):
+		init_image, input_image, mask = make_inputs(size, seed)
+		expected = composite_old(mask, init_image, input_image)
+		result = run_new(init_image, input_image, mask)
+		assert result.mode == expected.mode
+		assert result.tobytes() == expected.tobytes()
+
+
+def test_composite_numpy_input():
+	init_image, input_image, mask = make_inputs((96, 80), 3)
+	expected = composite_old(mask, init_image, input_image)
+	result = run_new(init_image, np.array(input_image), mask)
+	assert result.tobytes() == expected.tobytes()
+